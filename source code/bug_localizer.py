@@ -3,16 +3,21 @@ import sys
 from datetime import datetime
 from bug_data_retriever import get_bug_data
 from bug_report_processor import BugReportProcessor
+from snapshot_store import get_snapshot_registry
 import concurrent.futures
 import threading
 
 lock = threading.Lock()
 
-def process_bug(bug, project, output_file):
+def process_bug(bug, project, output_file, repository_search_budget=None):
     bug_report_processor = BugReportProcessor(
-        project, bug['bug_id'], str(bug['summary'] or 'N/A'), str(bug['description'] or 'N/A')
+        project, bug['bug_id'], str(bug['summary'] or 'N/A'), str(bug['description'] or 'N/A'),
+        repository_search_budget
     )
-    result = bug_report_processor.rank_files()
+    try:
+        result = bug_report_processor.rank_files()
+    finally:
+        bug_report_processor.close()
     
     with lock:
         with open(output_file, 'a', newline="", encoding='utf-8', errors='ignore') as output_csv:
@@ -20,13 +25,13 @@ def process_bug(bug, project, output_file):
             writer.writerow([bug['bug_id'], result, bug['fixed_files']])
 
 
-def process_bugs_parallelly(bugs, project, output_file):
+def process_bugs_parallelly(bugs, project, output_file, repository_search_budget=None):
     with open(output_file, 'w', newline="", encoding='utf-8', errors='ignore') as output_csv:
         writer = csv.writer(output_csv)
         writer.writerow(['bug_id', 'suspicious_files', 'fixed_files'])
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        executor.map(lambda bug: process_bug(bug, project, output_file), bugs)
+        executor.map(lambda bug: process_bug(bug, project, output_file, repository_search_budget), bugs)
 
 
 if __name__ == "__main__":
@@ -35,9 +40,12 @@ if __name__ == "__main__":
     project = sys.argv[1]
     input_xml_file = sys.argv[2]
     output_file = project + '_intermediate_ranking.csv'
+    # optional budget in milliseconds for repository-wide fuzzy method lookups
+    repository_search_budget = int(sys.argv[3]) / 1000 if len(sys.argv) > 3 else None
 
     bugs = get_bug_data(input_xml_file)
-    process_bugs_parallelly(bugs, project, output_file)
+    process_bugs_parallelly(bugs, project, output_file, repository_search_budget)
+    print("snapshot registry", get_snapshot_registry(project).get_stats())
 
     end_time = datetime.now()
     print("total time", end_time-start_time)
\ No newline at end of file
@@ -10,7 +10,7 @@ tools = [
         "type": "function",
         "function": {
             "name": "search_file",
-            "description": "Search for a Java file in the codebase using an inferred or guessed name. Returns the fully qualified filename if it exists.",
+            "description": "Search for a Java file in the codebase using an inferred or guessed name. Returns the fully qualified filename if it exists; otherwise returns the most similar filenames with similarity scores.",
             "strict": True,
             "parameters": {
                 "type": "object",
@@ -44,6 +44,25 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_code",
+            "description": "Search the bodies of all methods in the codebase for an error message, string literal or identifiers. Returns matching methods with the line that matched.",
+            "strict": True,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Text quoted in the bug report (e.g., an error message) or identifiers to look for (e.g., resolveTypeBinding)"
+                    }
+                },
+                "required": ["query"],
+                "additionalProperties": False
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -98,6 +117,48 @@ tools = [
                 "additionalProperties": False
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_callers",
+            "description": "Find the methods in the codebase that call a given method, without retrieving their bodies.",
+            "strict": True,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "method": {
+                        "type": "string",
+                        "description": "Name or full signature of the called method; a signature also matches the number of arguments."
+                    }
+                },
+                "required": ["method"],
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_callees",
+            "description": "List the methods called and the fields accessed by a method, with the files declaring each called method, without retrieving bodies.",
+            "strict": True,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "filename": {
+                        "type": "string",
+                        "description": "Fully qualified name of the file that contains the method."
+                    },
+                    "method_signature": {
+                        "type": "string",
+                        "description": "The full signature of the method whose calls should be listed."
+                    }
+                },
+                "required": ["filename", "method_signature"],
+                "additionalProperties": False
+            }
+        }
     }
 ]
 
@@ -105,14 +166,14 @@ tools = [
 
 class BugReportProcessor:
     _dir_creation_lock = threading.Lock()
-    def __init__(self, project, bug_id, bug_report_summary, bug_report_description):
+    def __init__(self, project, bug_id, bug_report_summary, bug_report_description, repository_search_budget=None):
         if not all([project, bug_id, bug_report_summary, bug_report_description]):
             raise ValueError("All parameters must be non-empty")
         self.project = project
         self.bug_id = bug_id
         self.bug_report_summary = bug_report_summary
         self.bug_report_description = bug_report_description
-        self.file_data_processor = FileDataProcessor(self.project, self.bug_id)
+        self.file_data_processor = FileDataProcessor(self.project, self.bug_id, repository_search_budget)
         self.openai_client_manager = OpenAIClientManager()
         
         self.project_log_dir = os.path.join(os.getcwd(), self.project)
@@ -128,6 +189,9 @@ class BugReportProcessor:
             self.logger.addHandler(file_handler)
             self.logger.setLevel(logging.INFO)
 
+    def close(self):
+        self.file_data_processor.close()
+
     def create_prompt(self):
         prompt = f"""
 Given a bug report, your goal is to analyze and rank files by their likelihood of containing the bug. 
@@ -144,7 +208,7 @@ Bug Report Description:
         return clean_string
     
     def rank_files(self):
-        system_content = """You are an expert software engineer specializing in fault localization. Your goal is to identify the most probable buggy Java files based on a given bug report. You have access to five functions that will help you infer file names, locate methods, and analyze source code. You must follow an iterative, reasoning-based approach, refining your strategy dynamically based on prior successes and failures. Continue this process until you either (a) produce a well-justified ranked list of the 10 most relevant files based on the bug report, or (b) reach the maximum limit of 10 iterations. **In the 10th iteration, you must provide your final output regardless of confidence level.**
+        system_content = """You are an expert software engineer specializing in fault localization. Your goal is to identify the most probable buggy Java files based on a given bug report. You have access to eight functions that will help you infer file names, locate methods, and analyze source code. You must follow an iterative, reasoning-based approach, refining your strategy dynamically based on prior successes and failures. Continue this process until you either (a) produce a well-justified ranked list of the 10 most relevant files based on the bug report, or (b) reach the maximum limit of 10 iterations. **In the 10th iteration, you must provide your final output regardless of confidence level.**
 
 **Workflow**  
 1. Analyze the Bug Report:
@@ -154,6 +218,8 @@ Bug Report Description:
 2. Search:
 - Use `search_file()` to check if a filename matching the extracted keywords or functionality exists in the codebase.  
 - If the bug report references a specific method name, use `search_method()` to locate the file(s) containing that method.  
+- If the bug report quotes an error message, string literal or identifier, use `search_code()` to find the methods whose code contains it.  
+- If `search_file()` finds no exact match, check the similar filenames it suggests before guessing new names.  
 - If an inferred filename or method location does not exist, refine your strategy: adjust assumptions, explore variations, and retry.  
 - If no strong inference can be made, use `get_candidate_filenames()` to retrieve 50 potential filenames.  
 - From the retrieved filenames, prioritize those that align with the bug report’s keywords, functionality, or mentioned methods.  
@@ -163,6 +229,7 @@ Bug Report Description:
 - Identify methods that directly align with the bug’s context (e.g., matching function names, handling related data).  
 - If method signatures suggest a relevant function, retrieve its implementation using `get_method_body()`.  
 - Analyze logic to determine if it aligns with the bug’s symptoms.  
+- To trace the bug through the code, use `find_callers()` and `find_callees()` to follow calls between methods before retrieving more bodies.  
 
 4. Refinement and Ranking:
 - Rank files based on multiple factors:  
@@ -252,6 +319,8 @@ Bug Report Description:
                             function_response = self.file_data_processor.search_file(function_args.get("filename"))
                         elif function_name == "search_method":
                             function_response = self.file_data_processor.search_method(function_args.get("method_name"))
+                        elif function_name == "search_code":
+                            function_response = self.file_data_processor.search_code(function_args.get("query"))
                         elif function_name == "get_candidate_filenames":
                             function_response = self.file_data_processor.get_candidate_filenames()
                         elif function_name == "get_method_signatures_of_a_file":
@@ -260,6 +329,11 @@ Bug Report Description:
                             method_signature = function_args.get("method_signature")
                             filename = function_args.get("filename")
                             function_response = self.file_data_processor.get_method_body(filename, method_signature)
+                        elif function_name == "find_callers":
+                            function_response = self.file_data_processor.find_callers(function_args.get("method"))
+                        elif function_name == "find_callees":
+                            function_response = self.file_data_processor.find_callees(
+                                function_args.get("filename"), function_args.get("method_signature"))
                         else:
                             function_response = {"error": f"Unknown function: {function_name}"}
                         
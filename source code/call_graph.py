@@ -0,0 +1,93 @@
+import json
+import zlib
+
+
+def get_call_key(name, arguments):
+    # calls are keyed by name and argument count, so overloads of different arity stay apart
+    return f"{name}/{arguments}"
+
+
+class CallGraphIndex:
+    """Caller/callee index over the references the parser extracts, kept in the snapshot store's database.
+
+    Like the code search postings, entries are keyed by file record: the methods of a record
+    that call a method, access a field or the record declaring a class are looked up by name,
+    and the calls and field accesses of every method are stored once per record.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS reference_postings ("
+            "kind TEXT, name TEXT, record_hash TEXT, method_indexes TEXT, "
+            "PRIMARY KEY (kind, name, record_hash)) WITHOUT ROWID")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS record_references (record_hash TEXT PRIMARY KEY, method_references BLOB)")
+
+    def add_records(self, records):
+        """Index record hash -> references of the file entry; the caller commits"""
+        posting_rows = []
+        reference_rows = []
+        for record_hash, references in records.items():
+            methods_by_key = {}
+            for method_index, method_references in enumerate(references['methods']):
+                for name, arguments, _ in method_references['calls']:
+                    methods_by_key.setdefault(('call', get_call_key(name, arguments)), {})[method_index] = None
+                for name, _ in method_references['fields']:
+                    methods_by_key.setdefault(('field', name), {})[method_index] = None
+            for class_name in references['classes']:
+                methods_by_key.setdefault(('class', class_name), {})
+            posting_rows.extend((kind, name, record_hash, ','.join(map(str, method_indexes)))
+                                for (kind, name), method_indexes in methods_by_key.items())
+            reference_rows.append((record_hash, zlib.compress(json.dumps(references).encode('utf-8'))))
+        self._connection.executemany("INSERT OR IGNORE INTO reference_postings VALUES (?, ?, ?, ?)", posting_rows)
+        self._connection.executemany("INSERT OR IGNORE INTO record_references VALUES (?, ?)", reference_rows)
+
+    def find_references(self, kind, name, record_hashes, arguments=None):
+        """Record hash -> indexes of the methods referencing the name, restricted to the given records.
+
+        Calls match any argument count unless one is given; class declarations map to no methods.
+        """
+        if kind == 'call' and arguments is None:
+            keys = self._get_call_keys(name)
+        else:
+            keys = [get_call_key(name, arguments) if kind == 'call' else name]
+        # each key is looked up only in the given records, so the cost follows the snapshot, not the store's history
+        found = {}
+        record_hashes = list(record_hashes)
+        for key in keys:
+            for i in range(0, len(record_hashes), 900):
+                subset_of_hashes = record_hashes[i:i + 900]
+                placeholders = ','.join('?' * len(subset_of_hashes))
+                for record_hash, method_indexes in self._connection.execute(
+                        "SELECT record_hash, method_indexes FROM reference_postings "
+                        f"WHERE kind = ? AND name = ? AND record_hash IN ({placeholders})",
+                        [kind, key, *subset_of_hashes]):
+                    found.setdefault(record_hash, {}).update((int(index), None) for index in method_indexes.split(',') if index)
+        return {record_hash: sorted(method_indexes) for record_hash, method_indexes in found.items()}
+
+    def _get_call_keys(self, name):
+        """Call keys of every arity of the name, found by seeking from one distinct key to the next"""
+        # every arity of the name sorts between 'name/' and 'name0'
+        keys = []
+        previous_key = name + '/'
+        while True:
+            row = self._connection.execute(
+                "SELECT name FROM reference_postings WHERE kind = 'call' AND name > ? AND name < ? ORDER BY name LIMIT 1",
+                (previous_key, name + '0')).fetchone()
+            if row is None:
+                return keys
+            previous_key = row[0]
+            keys.append(previous_key)
+
+    def load_references(self, record_hashes):
+        """Record hash -> references of the file entry, as add_records received them"""
+        references = {}
+        record_hashes = list(set(record_hashes))
+        for i in range(0, len(record_hashes), 900):
+            subset_of_hashes = record_hashes[i:i + 900]
+            placeholders = ','.join('?' * len(subset_of_hashes))
+            for record_hash, method_references in self._connection.execute(
+                    f"SELECT record_hash, method_references FROM record_references WHERE record_hash IN ({placeholders})",
+                    subset_of_hashes):
+                references[record_hash] = json.loads(zlib.decompress(method_references))
+        return references
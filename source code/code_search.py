@@ -0,0 +1,109 @@
+import re
+
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*')
+IDENTIFIER_PART_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+STRING_LITERAL_PATTERN = re.compile(r'"((?:[^"\\\n]|\\.)*)"')
+JAVA_KEYWORDS = {
+    'abstract', 'boolean', 'break', 'byte', 'case', 'catch', 'char', 'class', 'continue', 'default', 'do',
+    'double', 'else', 'extends', 'false', 'final', 'finally', 'float', 'for', 'if', 'implements', 'import',
+    'instanceof', 'int', 'interface', 'long', 'new', 'null', 'package', 'private', 'protected', 'public',
+    'return', 'short', 'static', 'super', 'switch', 'this', 'throw', 'throws', 'true', 'try', 'void', 'while'
+}
+# candidate files whose bodies are read to confirm a literal match
+MAX_LITERAL_CANDIDATES = 200
+
+
+def get_identifier_terms(text):
+    """Every identifier occurrence and its camelCase/snake_case parts, lower-cased, repeats kept"""
+    terms = []
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        lowered = identifier.lower()
+        if lowered in JAVA_KEYWORDS:
+            continue
+        terms.append(lowered)
+        parts = [part.lower() for part in IDENTIFIER_PART_PATTERN.findall(identifier) if len(part) > 1]
+        if len(parts) > 1 or (parts and parts[0] != lowered):
+            terms.extend(parts)
+    return terms
+
+
+def get_identifier_tokens(text):
+    """Whole identifiers plus their camelCase/snake_case parts, lower-cased"""
+    return set(get_identifier_terms(text))
+
+
+def get_substring_trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_literal_trigrams(text):
+    trigrams = set()
+    for literal in STRING_LITERAL_PATTERN.findall(text):
+        trigrams.update(get_substring_trigrams(literal))
+    return trigrams
+
+
+class CodeSearchIndex:
+    """Inverted index over method bodies, kept in the snapshot store's database.
+
+    Postings are keyed by file record, so only records a snapshot adds are ever indexed
+    and every snapshot shares the postings of the files it has in common with others.
+    Identifier tokens point at the methods using them; trigrams of string literals point
+    at the records containing them and narrow down substring searches.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS code_tokens ("
+            "token TEXT, record_hash TEXT, method_indexes TEXT, PRIMARY KEY (token, record_hash)) WITHOUT ROWID")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS code_trigrams ("
+            "trigram TEXT, record_hash TEXT, PRIMARY KEY (trigram, record_hash)) WITHOUT ROWID")
+
+    def add_records(self, records):
+        """Index record hash -> list of method bodies; the caller commits"""
+        token_rows = []
+        trigram_rows = []
+        for record_hash, bodies in records.items():
+            methods_by_token = {}
+            trigrams = set()
+            for method_index, body in enumerate(bodies):
+                for token in get_identifier_tokens(body):
+                    methods_by_token.setdefault(token, []).append(method_index)
+                trigrams.update(get_literal_trigrams(body))
+            token_rows.extend((token, record_hash, ','.join(map(str, method_indexes)))
+                              for token, method_indexes in methods_by_token.items())
+            trigram_rows.extend((trigram, record_hash) for trigram in trigrams)
+        self._connection.executemany("INSERT OR IGNORE INTO code_tokens VALUES (?, ?, ?)", token_rows)
+        self._connection.executemany("INSERT OR IGNORE INTO code_trigrams VALUES (?, ?)", trigram_rows)
+
+    def find_token(self, token, record_hashes):
+        """Record hash -> method indexes using the token, restricted to the given records"""
+        # the lookup seeks (token, record hash) pairs, so its cost follows the snapshot, not the store's history
+        found = {}
+        record_hashes = list(record_hashes)
+        for i in range(0, len(record_hashes), 900):
+            subset_of_hashes = record_hashes[i:i + 900]
+            placeholders = ','.join('?' * len(subset_of_hashes))
+            for record_hash, method_indexes in self._connection.execute(
+                    "SELECT record_hash, method_indexes FROM code_tokens "
+                    f"WHERE token = ? AND record_hash IN ({placeholders})", [token, *subset_of_hashes]):
+                found[record_hash] = [int(index) for index in method_indexes.split(',')]
+        return found
+
+    def find_literal_candidates(self, literal, record_hashes):
+        """Records whose string literals contain every trigram of the literal"""
+        candidates = set(record_hashes)
+        for trigram in get_substring_trigrams(literal):
+            remaining = list(candidates)
+            candidates = set()
+            for i in range(0, len(remaining), 900):
+                subset_of_hashes = remaining[i:i + 900]
+                placeholders = ','.join('?' * len(subset_of_hashes))
+                candidates.update(record_hash for record_hash, in self._connection.execute(
+                    f"SELECT record_hash FROM code_trigrams WHERE trigram = ? AND record_hash IN ({placeholders})",
+                    [trigram, *subset_of_hashes]))
+            if not candidates:
+                break
+        return candidates
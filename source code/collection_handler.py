@@ -1,52 +1,237 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 from config import Config
-from utils import calculate_hash, save_data_to_json, count_tokens
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from utils import calculate_hash, save_data_to_json, count_tokens_batch
+from text_chunker import TokenChunker
 from datetime import datetime
-from db_handler import get_file_collection
+from db_handler import get_file_collection, get_embedding_function, get_collection_listeners
+from embedding_cache import get_embedding_cache
+from exact_search import get_exact_search_index
+from lexical_search import get_lexical_search_index
 
-bug_report_splitter = RecursiveCharacterTextSplitter(
+# token budget per embedding request; a batch holds one per request an OpenAI client keeps in flight
+EMBEDDING_BATCH_TOKENS = 50000
+MAX_BATCH_SIZE = 700
+PIPELINE_QUEUE_SIZE = 4
+SUSPICIOUS_RESULTS = 300
+# damps the reciprocal rank fusion so a single retriever's top ranks do not dominate
+RRF_K = 60
+
+bug_report_splitter = TokenChunker(
     chunk_size = 8191,
-    chunk_overlap = 0,
-    length_function=count_tokens
+    batch_length_function=count_tokens_batch
 )
 
+def compute_embeddings(documents):
+    embedding_function = get_embedding_function()
+    if hasattr(embedding_function, 'embed'):
+        # local models hand over float32 arrays; the list round trip is left to chroma's upsert
+        embeddings = embedding_function.embed(documents)
+    else:
+        embeddings = embedding_function(documents)
+    if embeddings is None:
+        raise ValueError("Embedding function returned no embeddings")
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def embed_documents(ids, documents):
+    embedding_cache = get_embedding_cache()
+    if embedding_cache is None:
+        return None
+
+    embeddings, missing = embedding_cache.get_many(ids)
+    if missing:
+        new_embeddings = compute_embeddings([documents[i] for i in missing])
+        embedding_cache.put_many([ids[i] for i in missing], new_embeddings)
+        if embeddings is None:
+            embeddings = new_embeddings
+        else:
+            embeddings[missing] = new_embeddings
+    return embeddings
+
+
+def notify_added_chunks(ids, documents, metadata, embeddings):
+    for listener in get_collection_listeners():
+        listener.add_chunks(ids, documents, metadata, embeddings)
+
+
+class IngestionPipeline:
+    """Embeds and inserts chunks on background threads while the caller keeps producing them.
+
+    Chunks are grouped into batches bounded by a token budget. The queues between the
+    stages are bounded, so the producer blocks whenever embedding or insertion falls behind.
+    """
+    def __init__(self, file_collection, batch_tokens=None, max_batch_size=None, queue_size=PIPELINE_QUEUE_SIZE):
+        self.file_collection = file_collection
+        # only the OpenAI client spreads a batch over concurrent requests; local models take it in one go
+        embedding_concurrency = getattr(get_embedding_function(), 'max_concurrency', 1)
+        self.batch_tokens = batch_tokens or EMBEDDING_BATCH_TOKENS * embedding_concurrency
+        self.max_batch_size = max_batch_size or MAX_BATCH_SIZE * embedding_concurrency
+        self._seen_ids = set()
+        self._batch = []
+        self._num_batch_tokens = 0
+        self._error = None
+        self._embedding_queue = queue.Queue(maxsize=queue_size)
+        self._insertion_queue = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(target=self._run_stage, args=(self._embed_batches, self._insertion_queue), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._insert_batches, None), daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, ids, documents, metadata):
+        unseen = [i for i, chunk_id in enumerate(ids) if chunk_id not in self._seen_ids]
+        token_counts = count_tokens_batch([documents[i] for i in unseen]) if unseen else []
+        for i, num_tokens in zip(unseen, token_counts):
+            chunk_id, document, chunk_metadata = ids[i], documents[i], metadata[i]
+            if chunk_id in self._seen_ids:
+                continue
+            self._seen_ids.add(chunk_id)
+            if self._batch and (self._num_batch_tokens + num_tokens > self.batch_tokens or len(self._batch) >= self.max_batch_size):
+                self._flush_batch()
+            self._batch.append((chunk_id, document, chunk_metadata))
+            self._num_batch_tokens += num_tokens
+
+    def close(self):
+        """Push out the last batch and wait until everything is in the collection"""
+        try:
+            if self._batch:
+                self._flush_batch()
+        finally:
+            # the stages only stop once told to, so signal before waiting on them
+            self._end_stage(self._embedding_queue)
+            for thread in self._threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _flush_batch(self):
+        self._put(self._embedding_queue, tuple(map(list, zip(*self._batch))))
+        self._batch = []
+        self._num_batch_tokens = 0
+
+    def _put(self, stage_queue, item):
+        # a failed stage stops consuming, so never wait on it forever
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, stage_queue):
+        """The next item of a stage, or None once the input ends or any stage has failed"""
+        while self._error is None:
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _end_stage(self, stage_queue):
+        """Send the end of input downstream; after a failure the downstream stage stops by itself"""
+        try:
+            self._put(stage_queue, None)
+        except BaseException:
+            try:
+                stage_queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _run_stage(self, stage, downstream_queue):
+        try:
+            stage()
+        except BaseException as error:
+            if self._error is None:
+                self._error = error
+        finally:
+            if downstream_queue is not None:
+                self._end_stage(downstream_queue)
+
+    def _embed_batches(self):
+        while True:
+            batch = self._get(self._embedding_queue)
+            if batch is None:
+                return
+            ids, documents, metadata = batch
+            self._put(self._insertion_queue, (ids, documents, metadata, embed_documents(ids, documents)))
+
+    def _insert_batches(self):
+        while True:
+            batch = self._get(self._insertion_queue)
+            if batch is None:
+                return
+            ids, documents, metadata, embeddings = batch
+            # upsert rather than add: a persistent collection drops an add whose id was
+            # deleted earlier in the same unflushed batch, which happens on every MODIFY
+            self.file_collection.upsert(
+                documents=documents,
+                metadatas=metadata,
+                embeddings=embeddings.tolist() if embeddings is not None else None,
+                ids=ids
+            )
+            notify_added_chunks(ids, documents, metadata, embeddings)
+
+
 def insert_into_file_collection(file_collection, documents, metadata):
-    # starting_time = datetime.now()
-    
     ids = [calculate_hash(metadata[i]['file']+documents[i]) for i in range(len(documents))]
-    set_of_ids = set()
-    indexes = []
-    for index, value in enumerate(ids):
-        if value not in set_of_ids:
-            set_of_ids.add(value)         
-        else:
-            indexes.append(index)
-            # print(index, "duplicate")
+    pipeline = IngestionPipeline(file_collection)
+    pipeline.add(ids, documents, metadata)
+    pipeline.close()
 
-    updated_documents = [x for i, x in enumerate(documents) if i not in indexes]
-    updated_metadata = [x for i, x in enumerate(metadata) if i not in indexes]
-    updated_ids = [x for i, x in enumerate(ids) if i not in indexes]
 
-    max_batch_size = 700
-    for i in range(0, len(updated_documents), max_batch_size):
-        subset_of_documents = updated_documents[i:i + max_batch_size]
-        subset_of_metadata = updated_metadata[i:i + max_batch_size]
-        subset_of_ids= updated_ids[i:i + max_batch_size]
-
-        file_collection.add(
-            documents=subset_of_documents,
-            metadatas=subset_of_metadata,
-            ids=subset_of_ids
+def insert_precomputed_chunks(file_collection, ids, documents, metadata, embeddings):
+    unique_indexes = list({chunk_id: i for i, chunk_id in reversed(list(enumerate(ids)))}.values())[::-1]
+    for i in range(0, len(unique_indexes), MAX_BATCH_SIZE):
+        batch = unique_indexes[i:i + MAX_BATCH_SIZE]
+        file_collection.upsert(
+            documents=[documents[j] for j in batch],
+            metadatas=[metadata[j] for j in batch],
+            embeddings=[list(embeddings[j]) for j in batch],
+            ids=[ids[j] for j in batch]
         )
-        # print("db size: ", collection.count())
-    # ending_time = datetime.now()
-    # print("insertion time:", ending_time-starting_time)
+        notify_added_chunks([ids[j] for j in batch], [documents[j] for j in batch], [metadata[j] for j in batch],
+                            [embeddings[j] for j in batch])
+
+
+def delete_chunks_by_id(file_collection, ids):
+    ids = list(dict.fromkeys(ids))
+    max_batch_size = 700
+    for i in range(0, len(ids), max_batch_size):
+        file_collection.delete(ids=ids[i:i + max_batch_size])
+    for listener in get_collection_listeners():
+        listener.delete_chunks(ids)
+
+
+def get_chunks_by_id(file_collection, ids):
+    ids = list(dict.fromkeys(ids))
+    chunks = {}
+    max_batch_size = 700
+    for i in range(0, len(ids), max_batch_size):
+        data = file_collection.get(ids=ids[i:i + max_batch_size], include=["documents", "embeddings"])
+        chunks.update(zip(data["ids"], zip(data["documents"], data["embeddings"])))
+    return chunks
+
+
+def get_chunk_ids_by_file(file_collection):
+    data = file_collection.get(include=["metadatas"])
+    chunk_ids_by_file = {}
+    for chunk_id, metadata in zip(data["ids"], data["metadatas"]):
+        chunk_ids_by_file.setdefault(metadata["file"], []).append(chunk_id)
+    return chunk_ids_by_file
 
 
 def delete_from_file_collection(file_collection, file_path):
     file_collection.delete(
         where={"file": file_path}
     )
+    for listener in get_collection_listeners():
+        listener.delete_file(file_path)
     # print("db size: ", collection.count())
 
 
@@ -70,6 +255,75 @@ def get_data_from_file_collection(file_collection):
     print(file_collection.get(include = ["metadatas"]))
 
 
+def get_file_results(file_collection, file_results):
+    """Ranked (file path, score, chunk id) lists laid out like a collection query, distance being one minus the score"""
+    chunk_ids = list(dict.fromkeys(chunk_id for results in file_results for _, _, chunk_id in results))
+    documents = {}
+    for i in range(0, len(chunk_ids), MAX_BATCH_SIZE):
+        data = file_collection.get(ids=chunk_ids[i:i + MAX_BATCH_SIZE], include=["documents"])
+        documents.update(zip(data["ids"], data["documents"]))
+    return {
+        'documents': [[documents[chunk_id] for _, _, chunk_id in results] for results in file_results],
+        'metadatas': [[{"file": file_path} for file_path, _, _ in results] for results in file_results],
+        'distances': [[1 - score for _, score, _ in results] for results in file_results]
+    }
+
+
+def query_exact_search(file_collection, query_embeddings, n_files, file_pooling=None):
+    """Exact search laid out like a collection query, with one entry per file, best file first.
+
+    Each file is represented by its best chunk and the distance is one minus its pooled score.
+    """
+    file_results = get_exact_search_index().search(
+        query_embeddings, n_files, file_pooling or Config().get_file_pooling(), file_collection)
+    return get_file_results(file_collection, file_results)
+
+
+def get_dense_file_ranking(file_collection, query_texts, n_files):
+    """Files ranked by their closest chunk to any of the query texts in the HNSW index"""
+    results = file_collection.query(query_texts=query_texts, n_results=SUSPICIOUS_RESULTS,
+                                    include=['metadatas', 'distances'])
+    best_chunks = {}
+    for ids, metadatas, distances in zip(results['ids'], results['metadatas'], results['distances']):
+        for chunk_id, metadata, distance in zip(ids, metadatas, distances):
+            if metadata['file'] not in best_chunks or distance < best_chunks[metadata['file']][0]:
+                best_chunks[metadata['file']] = (distance, chunk_id)
+    ranking = sorted(best_chunks.items(), key=lambda item: item[1][0])[:n_files]
+    return [(file_path, 1 - distance, chunk_id) for file_path, (distance, chunk_id) in ranking]
+
+
+def query_hybrid_search(file_collection, query_texts, content, n_files):
+    """Dense and BM25 file rankings merged by reciprocal rank fusion, as a single collection query row.
+
+    Both retrievers run at once. With a latency budget, a retriever still running when it
+    runs out is left out of the fusion, unless neither has finished yet.
+    """
+    # a rebuild after a reset happens here, outside the budget, so it is never left running in the background
+    get_lexical_search_index().refresh(file_collection)
+    executor = ThreadPoolExecutor(max_workers=2)
+    rankings = {
+        'dense': executor.submit(get_dense_file_ranking, file_collection, query_texts, n_files),
+        'lexical': executor.submit(get_lexical_search_index().search, content, n_files, file_collection)
+    }
+    executor.shutdown(wait=False)
+    done, not_done = wait(rankings.values(), timeout=Config().get_hybrid_latency_budget() or None)
+    if not done:
+        done, not_done = wait(rankings.values(), return_when=FIRST_COMPLETED)
+
+    fused = {}
+    for name, ranking in rankings.items():
+        if ranking in not_done:
+            print('hybrid search:', name, 'retrieval missed the latency budget')
+            continue
+        for rank, (file_path, _, chunk_id) in enumerate(ranking.result(), start=1):
+            # the dense ranking goes first, so its chunk represents the files both retrievers find
+            score, best_chunk_id = fused.get(file_path, (0, chunk_id))
+            fused[file_path] = (score + 1 / (RRF_K + rank), best_chunk_id)
+    file_results = sorted(fused.items(), key=lambda item: -item[1][0])[:n_files]
+    return get_file_results(file_collection, [[(file_path, score, chunk_id)
+                                               for file_path, (score, chunk_id) in file_results]])
+
+
 def get_suspicious_files(bug_id, content):
     if content is None or '':
         print("no content!!!!!!!")
@@ -77,11 +331,16 @@ def get_suspicious_files(bug_id, content):
     file_collection = get_file_collection()
     bug_report_chunks = bug_report_splitter.split_text(content)
 
-    results = file_collection.query(
-        query_texts=bug_report_chunks,
-        n_results=300,
-        include=['documents', 'metadatas' , 'distances'] 
-    )
+    if Config().get_retrieval_backend() == 'exact':
+        results = query_exact_search(file_collection, compute_embeddings(bug_report_chunks), SUSPICIOUS_RESULTS)
+    elif Config().get_retrieval_backend() == 'hybrid':
+        results = query_hybrid_search(file_collection, bug_report_chunks, content, SUSPICIOUS_RESULTS)
+    else:
+        results = file_collection.query(
+            query_texts=bug_report_chunks,
+            n_results=SUSPICIOUS_RESULTS,
+            include=['documents', 'metadatas' , 'distances']
+        )
 
     # print(results)
 
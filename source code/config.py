@@ -3,7 +3,9 @@ import threading
 class Config:
     _instance = None
     _lock = threading.Lock()
-    VALID_EMBEDDING_TYPES = ['gte', 'openai', 'jina']
+    VALID_EMBEDDING_TYPES = ['gte', 'openai', 'jina', 'gte-onnx']
+    VALID_RETRIEVAL_BACKENDS = ['hnsw', 'exact', 'hybrid']
+    VALID_FILE_POOLINGS = ['max', 'mean']
 
     def __new__(cls):
         """Thread-safe Singleton instantiation"""
@@ -19,6 +21,16 @@ class Config:
         if not self._initialized:
             self._project = ""
             self._embedding_type = self.VALID_EMBEDDING_TYPES[0]  # Default embedding
+            self._num_workers = 1  # Serial ingestion
+            self._db_path = ""  # In-memory index
+            self._snapshot_interval = 0  # No snapshots
+            self._embedding_concurrency = 4  # Embedding requests in flight
+            self._embedding_batch_size = 32  # Chunks per local embedding batch
+            self._embedding_threads = 0  # Torch default
+            self._embedding_processes = 1  # Local embedding in this process
+            self._retrieval_backend = self.VALID_RETRIEVAL_BACKENDS[0]  # Chroma's HNSW index
+            self._file_pooling = self.VALID_FILE_POOLINGS[0]  # Best chunk scores the file
+            self._hybrid_latency_budget = 0  # Wait for both retrievers
             self._initialized = True
 
     def get_project(self):
@@ -29,6 +41,46 @@ class Config:
         """Get the embedding type"""
         return self._embedding_type
 
+    def get_num_workers(self):
+        """Get the number of ingestion worker processes"""
+        return self._num_workers
+
+    def get_db_path(self):
+        """Get the directory of the persistent index"""
+        return self._db_path
+
+    def get_snapshot_interval(self):
+        """Get the number of bugs between index snapshots"""
+        return self._snapshot_interval
+
+    def get_embedding_concurrency(self):
+        """Get the number of embedding requests kept in flight"""
+        return self._embedding_concurrency
+
+    def get_embedding_batch_size(self):
+        """Get the number of chunks per local embedding batch"""
+        return self._embedding_batch_size
+
+    def get_embedding_threads(self):
+        """Get the number of threads per local embedding process"""
+        return self._embedding_threads
+
+    def get_embedding_processes(self):
+        """Get the number of local embedding processes"""
+        return self._embedding_processes
+
+    def get_retrieval_backend(self):
+        """Get the index answering suspicious file queries"""
+        return self._retrieval_backend
+
+    def get_file_pooling(self):
+        """Get how exact search pools chunk scores into file scores"""
+        return self._file_pooling
+
+    def get_hybrid_latency_budget(self):
+        """Get the seconds a hybrid query waits for its slower retriever"""
+        return self._hybrid_latency_budget
+
     def set_project(self, project):
         """Set the project name"""
         if isinstance(project, str) and project:
@@ -42,3 +94,74 @@ class Config:
             self._embedding_type = embedding_type
         else:
             raise ValueError(f"Embedding type must be one of {self.VALID_EMBEDDING_TYPES}")
+
+
+    def set_num_workers(self, num_workers):
+        """Set the number of ingestion worker processes"""
+        if isinstance(num_workers, int) and num_workers > 0:
+            self._num_workers = num_workers
+        else:
+            raise ValueError("Number of workers must be a positive integer")
+
+    def set_db_path(self, db_path):
+        """Set the directory of the persistent index"""
+        if isinstance(db_path, str):
+            self._db_path = db_path
+        else:
+            raise ValueError("Database path must be a string")
+
+    def set_snapshot_interval(self, snapshot_interval):
+        """Set the number of bugs between index snapshots"""
+        if isinstance(snapshot_interval, int) and snapshot_interval >= 0:
+            self._snapshot_interval = snapshot_interval
+        else:
+            raise ValueError("Snapshot interval must be a non-negative integer")
+
+    def set_embedding_concurrency(self, embedding_concurrency):
+        """Set the number of embedding requests kept in flight"""
+        if isinstance(embedding_concurrency, int) and embedding_concurrency > 0:
+            self._embedding_concurrency = embedding_concurrency
+        else:
+            raise ValueError("Embedding concurrency must be a positive integer")
+
+    def set_embedding_batch_size(self, embedding_batch_size):
+        """Set the number of chunks per local embedding batch"""
+        if isinstance(embedding_batch_size, int) and embedding_batch_size > 0:
+            self._embedding_batch_size = embedding_batch_size
+        else:
+            raise ValueError("Embedding batch size must be a positive integer")
+
+    def set_embedding_threads(self, embedding_threads):
+        """Set the number of threads per local embedding process"""
+        if isinstance(embedding_threads, int) and embedding_threads >= 0:
+            self._embedding_threads = embedding_threads
+        else:
+            raise ValueError("Embedding threads must be a non-negative integer")
+
+    def set_embedding_processes(self, embedding_processes):
+        """Set the number of local embedding processes"""
+        if isinstance(embedding_processes, int) and embedding_processes > 0:
+            self._embedding_processes = embedding_processes
+        else:
+            raise ValueError("Embedding processes must be a positive integer")
+
+    def set_retrieval_backend(self, retrieval_backend):
+        """Set the index answering suspicious file queries"""
+        if isinstance(retrieval_backend, str) and retrieval_backend in self.VALID_RETRIEVAL_BACKENDS:
+            self._retrieval_backend = retrieval_backend
+        else:
+            raise ValueError(f"Retrieval backend must be one of {self.VALID_RETRIEVAL_BACKENDS}")
+
+    def set_file_pooling(self, file_pooling):
+        """Set how exact search pools chunk scores into file scores"""
+        if isinstance(file_pooling, str) and file_pooling in self.VALID_FILE_POOLINGS:
+            self._file_pooling = file_pooling
+        else:
+            raise ValueError(f"File pooling must be one of {self.VALID_FILE_POOLINGS}")
+
+    def set_hybrid_latency_budget(self, hybrid_latency_budget):
+        """Set the seconds a hybrid query waits for its slower retriever, 0 for no limit"""
+        if isinstance(hybrid_latency_budget, (int, float)) and hybrid_latency_budget >= 0:
+            self._hybrid_latency_budget = hybrid_latency_budget
+        else:
+            raise ValueError("Hybrid latency budget must be a non-negative number of seconds")
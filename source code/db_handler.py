@@ -1,43 +1,175 @@
+import os
+import json
+import shutil
 import chromadb
 from chromadb import Settings
-from config import Config 
+from chromadb.api.client import SharedSystemClient
+from config import Config
+from embedding_cache import initialize_embedding_cache
 
-def initialize_db():
+# indexes kept next to the collection, told about every chunk added to or deleted from it
+collection_listeners = []
+
+def initialize_db(db_path=""):
+    global client, persist_directory
+    persist_directory = db_path
+    if db_path:
+        # reuse whatever the previous run left on disk instead of resetting it
+        client = chromadb.PersistentClient(path=os.path.join(db_path, 'current'), settings=Settings(allow_reset=True))
+    else:
+        client = chromadb.Client(settings=Settings(allow_reset=True))
+        client.reset()
+
+
+def close_db():
     global client
-    client = chromadb.Client(settings=Settings(allow_reset=True))
-    client.reset()
+    client._system.stop()
+    SharedSystemClient.clear_system_cache()
 
 
-def create_file_collection():
-    global client, file_collection
-    
+def initialize_embedding_function():
+    global embedding_function
+
     config = Config()
     embedding_type = config.get_embedding_type()
     if embedding_type == 'gte':
         from embedding_handler import AlibabaEmbedding
-        print('gte embedding') 
+        print('gte embedding')
         embedding_function = AlibabaEmbedding()
     elif embedding_type == 'openai':
         from embedding_handler import OpenAIEmbedding
         print('openai embedding')
         embedding_function = OpenAIEmbedding()
+    elif embedding_type == 'gte-onnx':
+        from embedding_handler import OnnxAlibabaEmbedding
+        print('gte onnx embedding')
+        embedding_function = OnnxAlibabaEmbedding()
     # else:
     #     from embedding_handler import JinaEmbedding
-    #     print('jina embedding') 
+    #     print('jina embedding')
     #     embedding_function = JinaEmbedding()
+    initialize_embedding_cache(f"{config.get_project()}_bug_data/embedding_cache", embedding_function.model_name)
+    return embedding_function
+
+
+def create_file_collection():
+    global client, file_collection
+
+    embedding_function = initialize_embedding_function()
     file_collection = client.create_collection(name='java-files', embedding_function= embedding_function, metadata={"hnsw:space": "cosine", "hnsw:M": 32})
+    reset_collection_listeners()
+
+    return file_collection
+
+
+def open_file_collection():
+    global client, file_collection
+
+    embedding_function = initialize_embedding_function()
+    file_collection = client.get_collection(name='java-files', embedding_function= embedding_function)
+    reset_collection_listeners()
 
     return file_collection
 
 
+def add_collection_listener(listener):
+    if listener not in collection_listeners:
+        collection_listeners.append(listener)
+
+
+def get_collection_listeners():
+    return collection_listeners
+
+
+def reset_collection_listeners():
+    # the collection was replaced wholesale, so listeners rebuild from it when next used
+    for listener in collection_listeners:
+        listener.reset()
+
+
+def get_embedding_function():
+    global embedding_function
+    return embedding_function
+
+
 def delete_file_collection():
     global client
     try:
         client.delete_collection('java-files')
+        reset_collection_listeners()
     except:
         print('file collection does not exist')
 
 
 def get_file_collection():
     global file_collection
-    return file_collection
\ No newline at end of file
+    return file_collection
+
+
+def write_json_atomically(data, filename):
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'w') as json_file:
+        json.dump(data, json_file, indent=4)
+    os.replace(temporary_filename, filename)
+
+
+def save_index_state(bug_id, commit, complete):
+    global persist_directory
+    if persist_directory:
+        index_state = {"bug_id": bug_id, "commit": commit, "complete": complete}
+        write_json_atomically(index_state, os.path.join(persist_directory, 'index_state.json'))
+
+
+def load_index_state():
+    global persist_directory
+    state_file = os.path.join(persist_directory, 'index_state.json')
+    if not persist_directory or not os.path.exists(state_file):
+        return None
+    with open(state_file, 'r') as json_file:
+        return json.load(json_file)
+
+
+def get_snapshot_directory(name):
+    global persist_directory
+    return os.path.join(persist_directory, 'snapshots', name.replace('/', '_'))
+
+
+def save_snapshot(name, bug_id):
+    global persist_directory
+    if not persist_directory:
+        return
+    snapshot_directory = get_snapshot_directory(name)
+    if os.path.exists(snapshot_directory):
+        shutil.rmtree(snapshot_directory)
+    shutil.copytree(os.path.join(persist_directory, 'current'), os.path.join(snapshot_directory, 'index'))
+    write_json_atomically({"bug_id": bug_id, "commit": name, "complete": True},
+                          os.path.join(snapshot_directory, 'index_state.json'))
+
+
+def list_snapshots():
+    global persist_directory
+    snapshots = {}
+    snapshots_directory = os.path.join(persist_directory, 'snapshots')
+    if persist_directory and os.path.exists(snapshots_directory):
+        for name in os.listdir(snapshots_directory):
+            state_file = os.path.join(snapshots_directory, name, 'index_state.json')
+            if os.path.exists(state_file):
+                with open(state_file, 'r') as json_file:
+                    index_state = json.load(json_file)
+                snapshots[index_state['commit']] = index_state
+    return snapshots
+
+
+def load_snapshot(name):
+    """Replace the live index with the snapshot taken at the given commit"""
+    global persist_directory
+    snapshot_directory = get_snapshot_directory(name)
+    close_db()
+    current_directory = os.path.join(persist_directory, 'current')
+    shutil.rmtree(current_directory, ignore_errors=True)
+    shutil.copytree(os.path.join(snapshot_directory, 'index'), current_directory)
+    initialize_db(persist_directory)
+    reset_collection_listeners()
+    shutil.copyfile(os.path.join(snapshot_directory, 'index_state.json'),
+                    os.path.join(persist_directory, 'index_state.json'))
+    return load_index_state()
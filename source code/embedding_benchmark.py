@@ -0,0 +1,68 @@
+import sys
+import time
+import numpy as np
+from config import Config
+from embedding_handler import AlibabaEmbedding, shutdown_encode_pool
+from file_parser import initialize_parser, extract_package_and_methods
+from file_processor import chunk_files_data
+from parser_benchmark import read_java_files
+
+
+def encode_with_defaults(documents):
+    """What AlibabaEmbedding did before the throughput mode, kept as the baseline"""
+    AlibabaEmbedding._load_model()
+    return AlibabaEmbedding._model.encode(documents, convert_to_numpy=True).tolist()
+
+
+def get_documents(repo_path, num_chunks):
+    documents = []
+    for content in read_java_files(repo_path):
+        package, methods, references = extract_package_and_methods(content)
+        _, file_documents, _ = chunk_files_data([('benchmark.java', package, methods, references)])[0]
+        documents.extend(file_documents)
+        if len(documents) >= num_chunks:
+            break
+    return documents[:num_chunks]
+
+
+def main():
+    repo_path = sys.argv[1]
+    num_chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    config = Config()
+    config.set_project('benchmark')
+    config.set_embedding_type('gte')
+    if len(sys.argv) > 3:
+        config.set_embedding_batch_size(int(sys.argv[3]))
+    if len(sys.argv) > 4:
+        config.set_embedding_threads(int(sys.argv[4]))
+    if len(sys.argv) > 5:
+        config.set_embedding_processes(int(sys.argv[5]))
+
+    initialize_parser()
+    documents = get_documents(repo_path, num_chunks)
+    embedding_function = AlibabaEmbedding()
+    print('chunks', len(documents), 'batch size', embedding_function.batch_size,
+          'threads', embedding_function.num_threads, 'processes', embedding_function.num_processes)
+
+    # load the model (and start the workers) before timing
+    embedding_function.embed(documents[:8])
+    encode_with_defaults(documents[:8])
+
+    starting_time = time.perf_counter()
+    baseline = np.asarray(encode_with_defaults(documents), dtype=np.float32)
+    baseline_seconds = time.perf_counter() - starting_time
+    starting_time = time.perf_counter()
+    embeddings = embedding_function.embed(documents)
+    throughput_seconds = time.perf_counter() - starting_time
+    shutdown_encode_pool()
+
+    cosines = np.sum(baseline * embeddings, axis=1) / (
+        np.linalg.norm(baseline, axis=1) * np.linalg.norm(embeddings, axis=1))
+    print('default encode', round(baseline_seconds, 3), 's', round(len(documents) / baseline_seconds, 1), 'chunks/s')
+    print('throughput mode', round(throughput_seconds, 3), 's', round(len(documents) / throughput_seconds, 1), 'chunks/s')
+    print('speed-up', round(baseline_seconds / throughput_seconds, 2))
+    print('min cosine to default encode', round(float(cosines.min()), 6))
+
+
+if __name__ == "__main__":
+    main()
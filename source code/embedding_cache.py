@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+
+embedding_cache = None
+
+
+class EmbeddingCache:
+    """Persistent float32 vector store keyed by chunk hash, one per embedding model.
+
+    Vectors are appended to a raw float32 file that is read through a memory map,
+    and a small SQLite table maps each chunk hash to its row in that file.
+    """
+    def __init__(self, cache_dir, model_name):
+        self.cache_dir = os.path.join(cache_dir, model_name.replace('/', '_'))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors_path = os.path.join(self.cache_dir, 'vectors.f32')
+        self._vectors = None
+
+        self._connection = sqlite3.connect(
+            os.path.join(self.cache_dir, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS vectors (chunk_id TEXT PRIMARY KEY, row INTEGER)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache_info (key TEXT PRIMARY KEY, value TEXT)")
+        row = self._connection.execute("SELECT value FROM cache_info WHERE key = 'dimension'").fetchone()
+        self.dimension = int(row[0]) if row else None
+        self._num_rows = self._connection.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        if self.dimension is not None and os.path.exists(self._vectors_path):
+            # drop rows appended by a run that died before committing their ids
+            with open(self._vectors_path, 'r+b') as vectors_file:
+                vectors_file.truncate(self._num_rows * self.dimension * 4)
+
+    def _get_vectors(self):
+        if self._vectors is None or self._vectors.shape[0] < self._num_rows:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r',
+                                      shape=(self._num_rows, self.dimension))
+        return self._vectors
+
+    def get_many(self, chunk_ids):
+        """Return a float32 matrix of cached vectors and the positions that were not cached"""
+        with self._lock:
+            rows = {}
+            for i in range(0, len(chunk_ids), 900):
+                subset_of_ids = chunk_ids[i:i + 900]
+                placeholders = ','.join('?' * len(subset_of_ids))
+                rows.update(self._connection.execute(
+                    f"SELECT chunk_id, row FROM vectors WHERE chunk_id IN ({placeholders})", subset_of_ids))
+
+            missing = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in rows]
+            self.hits += len(chunk_ids) - len(missing)
+            self.misses += len(missing)
+            if not rows:
+                return None, missing
+
+            embeddings = np.zeros((len(chunk_ids), self.dimension), dtype=np.float32)
+            positions = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id in rows]
+            embeddings[positions] = self._get_vectors()[[rows[chunk_ids[i]] for i in positions]]
+            return embeddings, missing
+
+    def put_many(self, chunk_ids, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = embeddings.shape[1]
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO cache_info VALUES ('dimension', ?)", (str(self.dimension),))
+            known = set()
+            for i in range(0, len(chunk_ids), 900):
+                subset_of_ids = chunk_ids[i:i + 900]
+                placeholders = ','.join('?' * len(subset_of_ids))
+                known.update(chunk_id for chunk_id, in self._connection.execute(
+                    f"SELECT chunk_id FROM vectors WHERE chunk_id IN ({placeholders})", subset_of_ids))
+
+            new_rows = {}
+            for i, chunk_id in enumerate(chunk_ids):
+                if chunk_id not in known and chunk_id not in new_rows:
+                    new_rows[chunk_id] = i
+            if not new_rows:
+                return
+
+            with open(self._vectors_path, 'ab') as vectors_file:
+                vectors_file.write(embeddings[list(new_rows.values())].tobytes())
+            self._connection.executemany(
+                "INSERT INTO vectors VALUES (?, ?)",
+                [(chunk_id, self._num_rows + row) for row, chunk_id in enumerate(new_rows)])
+            self._connection.commit()
+            self._num_rows += len(new_rows)
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model_name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0,
+                "vectors": self._num_rows
+            }
+
+    def close(self):
+        self._vectors = None
+        self._connection.close()
+
+
+def initialize_embedding_cache(cache_dir, model_name):
+    global embedding_cache
+    if embedding_cache is None or embedding_cache.model_name != model_name:
+        embedding_cache = EmbeddingCache(cache_dir, model_name)
+
+
+def get_embedding_cache():
+    global embedding_cache
+    return embedding_cache
@@ -1,41 +1,244 @@
 from chromadb import Documents, EmbeddingFunction, Embeddings
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from openai import OpenAI, APIConnectionError, APIStatusError
+from config import Config
+import json
+import math
+import multiprocessing
+import numpy as np
+import os
+import random
+import re
+import threading
 import tiktoken
 import time
 
+encode_pool = None
+encode_pool_settings = None
+encode_worker_class = None
+
 class BaseEmbedding(EmbeddingFunction):
     """Base class for embedding functions"""
     def __call__(self, input: Documents) -> Embeddings:
         raise NotImplementedError("Subclasses must implement __call__")
 
 class AlibabaEmbedding(BaseEmbedding):
+    """gte-modernbert embeddings computed locally, tuned for throughput on CPU.
+
+    Chunks are sorted by token count and grouped with chunks of similar length, so short
+    chunks are not padded to the longest of a mixed batch. A batch holds batch_size chunks
+    of REFERENCE_LENGTH tokens, or proportionally more of shorter ones. With several
+    processes the batches are spread over a pool of workers holding their own model copy.
+    """
+    model_name = 'Alibaba-NLP/gte-modernbert-base'
+    REFERENCE_LENGTH = 256
+    MAX_BATCH_MULTIPLIER = 4
     _model = None
     _tokenizer = None
 
+    def __init__(self, batch_size=None, num_threads=None, num_processes=None):
+        config = Config()
+        self.batch_size = batch_size or config.get_embedding_batch_size()
+        self.num_processes = num_processes or config.get_embedding_processes()
+        self.num_threads = num_threads if num_threads is not None else config.get_embedding_threads()
+        if self.num_threads == 0 and self.num_processes > 1:
+            # split the cores between the workers instead of letting each one use all of them
+            self.num_threads = max(1, (os.cpu_count() or 1) // self.num_processes)
+        self._lock = threading.Lock()
+        self.chunks = 0
+        self.batches = 0
+        self.seconds = 0
+
     @classmethod
-    def _load_model(cls):
+    def _load_model(cls, num_threads=0):
         if cls._model is None:
+            from sentence_transformers import SentenceTransformer
+            if num_threads > 0:
+                import torch
+                torch.set_num_threads(num_threads)
             cls._model = SentenceTransformer(
-                'Alibaba-NLP/gte-modernbert-base',
+                cls.model_name,
                 trust_remote_code=True,
             )
             cls._tokenizer = cls._model.tokenizer
 
+    @classmethod
+    def _load_tokenizer(cls):
+        # ingestion workers only count tokens, so they skip loading the model weights
+        if cls._tokenizer is None:
+            from transformers import AutoTokenizer
+            cls._tokenizer = AutoTokenizer.from_pretrained(cls.model_name)
+
+    @classmethod
+    def count_tokens_batch(cls, texts):
+        cls._load_tokenizer()
+        return [len(input_ids) for input_ids in cls._tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+    @classmethod
+    def encode_batch(cls, texts):
+        cls._load_model()
+        return cls._model.encode(texts, batch_size=len(texts), convert_to_numpy=True).astype(np.float32, copy=False)
+
+    def get_batches(self, token_counts):
+        """Group input positions, longest first, into batches of about the same padded size"""
+        padded_tokens = self.batch_size * self.REFERENCE_LENGTH
+        max_batch_size = self.batch_size * self.MAX_BATCH_MULTIPLIER
+        batches = []
+        batch = []
+        for i in sorted(range(len(token_counts)), key=lambda i: -token_counts[i]):
+            # the first chunk of a batch is its longest, so it sets the padded length
+            if batch and ((len(batch) + 1) * max(token_counts[batch[0]], 1) > padded_tokens
+                          or len(batch) >= max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed(self, input: Documents):
+        """Embeddings as a float32 matrix, without going through Python lists"""
+        starting_time = time.perf_counter()
+        batches = self.get_batches(self.count_tokens_batch(input))
+        batch_texts = ([input[i] for i in batch] for batch in batches)
+        if self.num_processes > 1:
+            results = get_encode_pool(type(self), self.model_name, self.num_processes, self.num_threads).map(encode_batch, batch_texts)
+        else:
+            self._load_model(self.num_threads)
+            results = map(self.encode_batch, batch_texts)
+        embeddings = None
+        for batch, batch_embeddings in zip(batches, results):
+            if embeddings is None:
+                embeddings = np.empty((len(input), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[batch] = batch_embeddings
+        with self._lock:
+            self.chunks += len(input)
+            self.batches += len(batches)
+            self.seconds += time.perf_counter() - starting_time
+        return embeddings
+
     def __call__(self, input: Documents) -> Embeddings:
         try:
-            self._load_model()
-            embeddings = self._model.encode(input, convert_to_numpy=True)
-            return embeddings.tolist()
+            return self.embed(input).tolist()
         except Exception as e:
             print("Problem in embedding!")
             print(f"Alibaba embedding error: {e}")
             return None
 
+    def get_stats(self):
+        with self._lock:
+            return {
+                "chunks": self.chunks,
+                "batches": self.batches,
+                "seconds": round(self.seconds, 2),
+                "chunks_per_second": round(self.chunks / self.seconds, 1) if self.seconds > 0 else 0
+            }
+
+
+class OnnxAlibabaEmbedding(AlibabaEmbedding):
+    """gte-modernbert run by ONNX Runtime from the model onnx_exporter.py writes to model_dir.
+
+    The exported graph includes the pooling, so a batch is tokenized and run in one call.
+    Vectors differ slightly from the PyTorch model, and more so when the export was
+    quantized, so they are cached under their own model name.
+    """
+    model_dir = 'gte_onnx'
+    _model = None
+    _tokenizer = None
+    _export_info = None
+
+    def __init__(self, batch_size=None, num_threads=None, num_processes=None):
+        super().__init__(batch_size, num_threads, num_processes)
+        self.model_name = self.get_export_info()['model_name']
+
+    @classmethod
+    def get_export_info(cls):
+        if cls._export_info is None:
+            try:
+                with open(os.path.join(cls.model_dir, 'export_info.json'), 'r') as file:
+                    cls._export_info = json.load(file)
+            except FileNotFoundError:
+                raise Exception(f"No exported model in '{cls.model_dir}', run onnx_exporter.py first")
+        return cls._export_info
+
+    @classmethod
+    def _load_model(cls, num_threads=0):
+        if cls._model is None:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads > 0:
+                options.intra_op_num_threads = num_threads
+            cls._model = onnxruntime.InferenceSession(
+                os.path.join(cls.model_dir, 'model.onnx'), options, providers=['CPUExecutionProvider'])
+            cls._load_tokenizer()
+
+    @classmethod
+    def _load_tokenizer(cls):
+        if cls._tokenizer is None:
+            from transformers import AutoTokenizer
+            cls._tokenizer = AutoTokenizer.from_pretrained(cls.model_dir)
+
+    @classmethod
+    def encode_batch(cls, texts):
+        cls._load_model()
+        export_info = cls.get_export_info()
+        features = cls._tokenizer(texts, padding=True, truncation=True, max_length=export_info['max_seq_length'],
+                                  return_tensors='np')
+        inputs = {name: features[name].astype(np.int64) for name in export_info['input_names']}
+        return cls._model.run(None, inputs)[0].astype(np.float32, copy=False)
+
+def encode_batch(texts):
+    return encode_worker_class.encode_batch(texts)
+
+
+def initialize_encode_worker(embedding_class, model_name, model_dir, num_threads):
+    global encode_worker_class
+    encode_worker_class = embedding_class
+    embedding_class.model_name = model_name
+    if model_dir is not None:
+        embedding_class.model_dir = model_dir
+    embedding_class._load_model(num_threads)
+
+
+def get_encode_pool(embedding_class, model_name, num_processes, num_threads):
+    global encode_pool, encode_pool_settings
+    # workers load their model once, so a pool started for another model or directory is replaced
+    settings = (embedding_class, model_name, getattr(embedding_class, 'model_dir', None), num_threads)
+    if encode_pool is not None and encode_pool_settings != (settings, num_processes):
+        shutdown_encode_pool()
+    if encode_pool is None:
+        # spawn instead of fork: the parent already holds chromadb/torch threads
+        encode_pool = ProcessPoolExecutor(
+            max_workers=num_processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=initialize_encode_worker,
+            initargs=settings
+        )
+        encode_pool_settings = (settings, num_processes)
+    return encode_pool
+
+
+def shutdown_encode_pool():
+    global encode_pool
+    if encode_pool is not None:
+        encode_pool.shutdown()
+        encode_pool = None
+
+
 def alibaba_tokenize(text):
-    AlibabaEmbedding._load_model()
+    AlibabaEmbedding._load_tokenizer()
     return len(AlibabaEmbedding._tokenizer.encode(text, add_special_tokens=False))
 
+def alibaba_tokenize_batch(texts):
+    return AlibabaEmbedding.count_tokens_batch(texts)
+
+def onnx_tokenize(text):
+    OnnxAlibabaEmbedding._load_tokenizer()
+    return len(OnnxAlibabaEmbedding._tokenizer.encode(text, add_special_tokens=False))
+
+def onnx_tokenize_batch(texts):
+    return OnnxAlibabaEmbedding.count_tokens_batch(texts)
+
 # class JinaEmbedding(BaseEmbedding):
 #     _model = None
 #     _tokenizer = None
@@ -63,39 +266,230 @@ def alibaba_tokenize(text):
 #     JinaEmbedding._load_model()
 #     return len(JinaEmbedding._tokenizer.encode(text, add_special_tokens=False))
 
+class EmbeddingError(Exception):
+    """Raised when an embedding request fails for good, instead of handing back no embeddings"""
+
+
+def parse_duration(value):
+    """Seconds in a rate-limit reset header such as '20ms', '1.5s' or '6m0s'"""
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r'([0-9.]+)(ms|s|m|h)', value or ''))
+
+
+class TokenBucket:
+    """Rate limiter refilling its capacity once per minute, the period of the API's limits.
+
+    The bucket may go into debt for a request larger than its capacity, so such a request
+    still runs once and the next ones wait for the debt to be paid off.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._resume_at = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def acquire(self, amount):
+        """Block until the amount is available, then take it; returns the seconds waited"""
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._resume_at and self._level >= min(amount, self.capacity):
+                    self._level -= amount
+                    return waited
+                # wake up at least every second to pick up limits the responses report meanwhile
+                delay = min(1, max(self._resume_at - now, (min(amount, self.capacity) - self._level) * 60 / self.capacity))
+            time.sleep(delay)
+            waited += delay
+
+    def update(self, limit, remaining, reset_seconds):
+        """Follow the limit the server reports and never assume more is left than it says"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit > 0:
+                self.capacity = limit
+            self._level = min(self._level, remaining)
+            if remaining <= 0:
+                self._resume_at = max(self._resume_at, now + reset_seconds)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
 class OpenAIEmbedding:
-    _api_key_loaded = False
-    _client = None
+    """Embedding client packing inputs into requests by token count and keeping several in flight.
+
+    Requests stay within the API limits on inputs and tokens per request and go through
+    token buckets for requests and tokens per minute, which follow the x-ratelimit headers
+    of every response. Throttled and failed requests are retried with exponential backoff;
+    once the retries run out an EmbeddingError is raised. OPENAI_BASE_URL points the client
+    at any OpenAI-compatible server.
+    """
+    model_name = "text-embedding-3-small"
     _tokenizer = tiktoken.get_encoding("cl100k_base")
+    MAX_INPUT_TOKENS = 8191
+    MAX_REQUEST_TOKENS = 300000
+    MAX_REQUEST_INPUTS = 2048
+    RETRYABLE_STATUS_CODES = (408, 409, 429)
 
-    def __call__(self, input: Documents) -> Embeddings:
-        if not OpenAIEmbedding._api_key_loaded:
-            try:
-                with open('api_key.txt', 'r') as file:
-                    api_key = file.read().strip()
-                OpenAIEmbedding._client = OpenAI(api_key=api_key)
-                OpenAIEmbedding._api_key_loaded = True
-            except FileNotFoundError:
-                raise Exception("API key file 'api_key.txt' not found")
-            except Exception as e:
-                raise Exception(f"Error reading API key: {e}")
+    def __init__(self, max_concurrency=None, requests_per_minute=3000, tokens_per_minute=1000000,
+                 max_retries=6, base_url=None, timeout=60):
+        self.max_concurrency = max_concurrency or Config().get_embedding_concurrency()
+        self.max_retries = max_retries
+        self.base_url = base_url
+        self.timeout = timeout
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._client = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.inputs = 0
+        self.tokens = 0
+        self.seconds = 0
+        self.throttled_seconds = 0
+
+    def _load_client(self):
+        with self._lock:
+            if self._client is None:
+                try:
+                    with open('api_key.txt', 'r') as file:
+                        api_key = file.read().strip()
+                except FileNotFoundError:
+                    raise Exception("API key file 'api_key.txt' not found")
+                except Exception as e:
+                    raise Exception(f"Error reading API key: {e}")
+                # retries are ours, so the client's own must not multiply them
+                self._client = OpenAI(api_key=api_key, base_url=self.base_url, max_retries=0, timeout=self.timeout)
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self._client
+
+    def pack_requests(self, token_counts):
+        """Split input indexes into contiguous requests within the API limits.
+
+        A call is spread over up to max_concurrency requests of at least MAX_INPUT_TOKENS
+        each, so large batches run in parallel while short queries stay a single request.
+        """
+        total_tokens = sum(token_counts)
+        num_requests = max(math.ceil(total_tokens / self.MAX_REQUEST_TOKENS),
+                           math.ceil(len(token_counts) / self.MAX_REQUEST_INPUTS),
+                           min(self.max_concurrency, total_tokens // self.MAX_INPUT_TOKENS), 1)
+        target_tokens = total_tokens / num_requests
+        target_inputs = math.ceil(len(token_counts) / num_requests)
+        requests = []
+        start = 0
+        request_tokens = 0
+        for i, num_tokens in enumerate(token_counts):
+            if i > start and (request_tokens + num_tokens > self.MAX_REQUEST_TOKENS
+                              or i - start >= self.MAX_REQUEST_INPUTS
+                              or request_tokens + num_tokens / 2 > target_tokens
+                              or (total_tokens == 0 and i - start >= target_inputs)):
+                requests.append((start, i, request_tokens))
+                start = i
+                request_tokens = 0
+            request_tokens += num_tokens
+        requests.append((start, len(token_counts), request_tokens))
+        return requests
+
+    def _update_limits(self, headers):
+        for bucket, kind in ((self._request_bucket, 'requests'), (self._token_bucket, 'tokens')):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is not None:
+                try:
+                    bucket.update(int(headers.get(f'x-ratelimit-limit-{kind}') or 0), int(remaining),
+                                  parse_duration(headers.get(f'x-ratelimit-reset-{kind}')))
+                except ValueError:
+                    pass
 
-        retries = 5
-        for attempt in range(retries):
+    def _get_retry_delay(self, error, attempt):
+        headers = error.response.headers if isinstance(error, APIStatusError) else {}
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            if headers.get('retry-after'):
+                return float(headers['retry-after'])
+        except ValueError:
+            pass
+        return min(60, 2 ** attempt) * random.uniform(0.5, 1)
+
+    def _embed_request(self, documents, num_tokens):
+        client = self._load_client()
+        for attempt in range(self.max_retries + 1):
+            throttled = self._request_bucket.acquire(1) + self._token_bucket.acquire(num_tokens)
+            with self._lock:
+                self.requests += 1
+                self.throttled_seconds += throttled
             try:
-                response = OpenAIEmbedding._client.embeddings.create(
-                    input=input,
-                    model="text-embedding-3-small"
-                )
-                embeddings = [data.embedding for data in response.data]
-                return embeddings
-            except Exception as e:
-                print("Problem in embedding!")
-                print(f"OpenAI embedding error: {e}")
-                time.sleep(5 * (attempt + 1))
-        return None
+                raw_response = client.embeddings.with_raw_response.create(input=documents, model=self.model_name)
+                self._update_limits(raw_response.headers)
+                response = raw_response.parse()
+                if len(response.data) != len(documents):
+                    raise EmbeddingError(f"Expected {len(documents)} embeddings, got {len(response.data)}")
+                return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+            except (APIConnectionError, APIStatusError) as e:
+                retryable = not isinstance(e, APIStatusError) or e.status_code in self.RETRYABLE_STATUS_CODES or e.status_code >= 500
+                if not retryable or attempt == self.max_retries:
+                    raise EmbeddingError(f"OpenAI embedding failed after {attempt + 1} attempts: {e}") from e
+                delay = self._get_retry_delay(e, attempt)
+                if isinstance(e, APIStatusError):
+                    self._update_limits(e.response.headers)
+                    if e.status_code == 429:
+                        # hold back every request, not only this one, until the window resets
+                        self._request_bucket.pause(delay)
+                with self._lock:
+                    self.retries += 1
+                print(f"OpenAI embedding error: {e}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def __call__(self, input: Documents) -> Embeddings:
+        if not input:
+            return []
+        starting_time = time.perf_counter()
+        self._load_client()
+        token_counts = openai_tokenize_batch(input)
+        requests = self.pack_requests(token_counts)
+        futures = [self._executor.submit(self._embed_request, input[start:end], num_tokens)
+                   for start, end, num_tokens in requests]
+        try:
+            embeddings = []
+            for future in futures:
+                embeddings.extend(future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        with self._lock:
+            self.inputs += len(input)
+            self.tokens += sum(token_counts)
+            self.seconds += time.perf_counter() - starting_time
+        return embeddings
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "inputs": self.inputs,
+                "tokens": self.tokens,
+                "seconds": round(self.seconds, 2),
+                "throttled_seconds": round(self.throttled_seconds, 2),
+                "tokens_per_second": round(self.tokens / self.seconds) if self.seconds > 0 else 0
+            }
 
 
 def openai_tokenize(text):
     """Tokenizer function for OpenAI embeddings"""        
     return len(OpenAIEmbedding._tokenizer.encode(text))
+
+
+def openai_tokenize_batch(texts):
+    return [len(tokens) for tokens in OpenAIEmbedding._tokenizer.encode_batch(texts)]
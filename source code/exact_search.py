@@ -0,0 +1,198 @@
+import threading
+import numpy as np
+from db_handler import add_collection_listener
+from embedding_cache import get_embedding_cache
+
+exact_search_index = None
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class ExactSearchIndex:
+    """Brute-force cosine search over every chunk of the collection, pooled into file scores.
+
+    Normalized embeddings sit in one contiguous float32 matrix, so a batch of queries costs
+    a single matrix multiply and the ranking is exact and deterministic. The index follows
+    the collection's add and delete events; deleted rows are only marked dead until they
+    make up half of the matrix. After a reset it rebuilds from the collection's ids and the
+    embedding cache on the next search.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._clear()
+            self._stale = True
+
+    def _clear(self):
+        self._vectors = None
+        self._num_rows = 0
+        self._num_dead = 0
+        self._row_ids = []
+        self._row_files = np.zeros(0, dtype=np.int32)
+        self._live = np.zeros(0, dtype=bool)
+        self._rows = {}
+        self._files = []
+        self._file_indexes = {}
+        self._file_groups = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add_chunks(self, ids, documents, metadatas, embeddings):
+        with self._lock:
+            if self._stale:
+                return
+            if embeddings is None:
+                # the collection embedded these itself, so only it knows the vectors
+                self._stale = True
+                return
+            self._add_rows(ids, [metadata['file'] for metadata in metadatas], embeddings)
+
+    def _add_rows(self, ids, files, embeddings):
+        # chunk ids hash the file and the text, so a known id already has the right vector
+        new_positions = {}
+        for i, chunk_id in enumerate(ids):
+            if chunk_id not in self._rows and chunk_id not in new_positions:
+                new_positions[chunk_id] = i
+        if not new_positions:
+            return
+        positions = list(new_positions.values())
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32)[positions])
+        self._reserve(self._num_rows + len(positions), vectors.shape[1])
+
+        end = self._num_rows + len(positions)
+        self._vectors[self._num_rows:end] = vectors
+        self._live[self._num_rows:end] = True
+        for row, (chunk_id, i) in enumerate(new_positions.items(), start=self._num_rows):
+            file_index = self._file_indexes.get(files[i])
+            if file_index is None:
+                file_index = self._file_indexes[files[i]] = len(self._files)
+                self._files.append(files[i])
+            self._row_files[row] = file_index
+            self._rows[chunk_id] = row
+            self._row_ids.append(chunk_id)
+        self._num_rows = end
+        self._file_groups = None
+
+    def _reserve(self, num_rows, dimension):
+        capacity = 0 if self._vectors is None else self._vectors.shape[0]
+        if num_rows <= capacity:
+            return
+        capacity = max(num_rows, capacity * 2, 1024)
+        vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        row_files = np.zeros(capacity, dtype=np.int32)
+        live = np.zeros(capacity, dtype=bool)
+        if self._vectors is not None:
+            vectors[:self._num_rows] = self._vectors[:self._num_rows]
+            row_files[:self._num_rows] = self._row_files[:self._num_rows]
+            live[:self._num_rows] = self._live[:self._num_rows]
+        self._vectors, self._row_files, self._live = vectors, row_files, live
+
+    def delete_chunks(self, ids):
+        with self._lock:
+            if self._stale:
+                return
+            for chunk_id in ids:
+                row = self._rows.pop(chunk_id, None)
+                if row is not None:
+                    self._live[row] = False
+                    self._num_dead += 1
+            self._file_groups = None
+            if self._num_dead > max(len(self._rows), 1024):
+                self._compact()
+
+    def delete_file(self, file_path):
+        file_index = self._file_indexes.get(file_path)
+        if file_index is not None:
+            rows = np.flatnonzero(self._live[:self._num_rows] & (self._row_files[:self._num_rows] == file_index))
+            self.delete_chunks([self._row_ids[row] for row in rows])
+
+    def _compact(self):
+        live_rows = np.flatnonzero(self._live[:self._num_rows])
+        vectors = self._vectors[live_rows]
+        ids = [self._row_ids[row] for row in live_rows]
+        files = [self._files[file_index] for file_index in self._row_files[live_rows]]
+        self._clear()
+        self._add_rows(ids, files, vectors)
+
+    def rebuild(self, file_collection):
+        """Reload every chunk from the collection, taking vectors from the embedding cache where it has them"""
+        data = file_collection.get(include=["metadatas"])
+        ids = data["ids"]
+        files = [metadata["file"] for metadata in data["metadatas"]]
+        embeddings, missing = (None, list(range(len(ids))))
+        if get_embedding_cache() is not None and ids:
+            embeddings, missing = get_embedding_cache().get_many(ids)
+        for i in range(0, len(missing), 700):
+            # chunks moved from another path keep their vectors under an id the cache never saw
+            batch = missing[i:i + 700]
+            found = file_collection.get(ids=[ids[j] for j in batch], include=["embeddings"])
+            vectors = dict(zip(found["ids"], found["embeddings"]))
+            if embeddings is None:
+                embeddings = np.zeros((len(ids), len(found["embeddings"][0])), dtype=np.float32)
+            embeddings[batch] = [vectors[ids[j]] for j in batch]
+        with self._lock:
+            self._clear()
+            if ids:
+                self._add_rows(ids, files, embeddings)
+            self._stale = False
+
+    def _get_file_groups(self):
+        """Live rows ordered by file, with where each file's run of rows starts"""
+        if self._file_groups is None:
+            live_rows = np.flatnonzero(self._live[:self._num_rows])
+            rows = live_rows[np.argsort(self._row_files[live_rows], kind='stable')]
+            row_files = self._row_files[rows]
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(row_files)) + 1)).astype(np.int64)
+            self._file_groups = (rows, starts, row_files[starts] if len(rows) else row_files)
+        return self._file_groups
+
+    def search(self, query_embeddings, n_files, pooling, file_collection):
+        """Per query, the n_files best files as (file path, score, id of the file's best chunk)"""
+        if self._stale:
+            self.rebuild(file_collection)
+        queries = normalize_rows(query_embeddings)
+        with self._lock:
+            rows, starts, group_files = self._get_file_groups()
+            if len(rows) == 0:
+                return [[] for _ in queries]
+            # one multiply for the whole batch, then the scores are regrouped by file
+            scores = (self._vectors[:self._num_rows] @ queries.T)[rows]
+            if pooling == 'mean':
+                file_scores = np.add.reduceat(scores, starts, axis=0) / np.diff(np.append(starts, len(rows)))[:, None]
+            else:
+                file_scores = np.maximum.reduceat(scores, starts, axis=0)
+
+            ends = np.append(starts[1:], len(rows))
+            results = []
+            for query_index in range(len(queries)):
+                query_scores = file_scores[:, query_index]
+                top = np.argpartition(-query_scores, n_files - 1)[:n_files] if n_files < len(query_scores) \
+                    else np.arange(len(query_scores))
+                top = top[np.lexsort((top, -query_scores[top]))]
+                results.append([
+                    (self._files[group_files[group]], float(query_scores[group]),
+                     self._row_ids[rows[starts[group] + int(np.argmax(scores[starts[group]:ends[group], query_index]))]])
+                    for group in top])
+            return results
+
+
+def initialize_exact_search_index():
+    global exact_search_index
+    if exact_search_index is None:
+        exact_search_index = ExactSearchIndex()
+        add_collection_listener(exact_search_index)
+    return exact_search_index
+
+
+def get_exact_search_index():
+    global exact_search_index
+    return exact_search_index
@@ -1,22 +1,95 @@
 import os
 import re
 import json
+from collections import namedtuple
+import time
+import numpy as np
 from itertools import islice
+from rapidfuzz import process
 from rapidfuzz.distance import DamerauLevenshtein
+from snapshot_store import get_snapshot_registry
+from trigram_index import TrigramIndex
+from code_search import get_identifier_tokens, MAX_LITERAL_CANDIDATES
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+OPENING_PARENTHESIS_PATTERN = re.compile(r'\(\s+')
+CLOSING_PARENTHESIS_PATTERN = re.compile(r'\s+\)')
+
+# signatures compared per vectorized call during a repository-wide search
+REPOSITORY_SEARCH_BATCH_SIZE = 5000
+
+# share of a fuzzy filename score that comes from the directory part, when the query has one
+DIRECTORY_SCORE_WEIGHT = 0.2
+
+LookupIndexes = namedtuple('LookupIndexes', ['paths_by_filename', 'methods_by_name', 'normalized_signatures'])
+FilenameIndexes = namedtuple('FilenameIndexes', ['paths', 'names', 'directories'])
 
 
 class FileDataProcessor:
-    def __init__(self, project, bug_id):
-        self.file_level_data = ''
+    def __init__(self, project, bug_id, repository_search_budget=None):
+        self.project = project
+        self.bug_id = bug_id
+        # seconds get_method_body may spend searching the whole repository when the file guess is wrong
+        self.repository_search_budget = repository_search_budget
+        self._snapshot = None
         self.suspicious_files = ''
-        self.process_file_level_data(
-            project+'_bug_data/' + bug_id + '_filewise_method_data.json')
         self.process_suspicious_filenames(
             project + '_bug_data/' + bug_id + '.json')
 
-    def process_file_level_data(self, file_path):
-        with open(file_path, 'r') as current_file:
-            self.file_level_data = json.load(current_file)
+    @property
+    def snapshot(self):
+        # the snapshot is only opened once a tool actually needs it
+        if self._snapshot is None:
+            self.process_file_level_data()
+        return self._snapshot
+
+    def process_file_level_data(self):
+        # concurrent bugs share one view per snapshot through the project's registry
+        self._snapshot = get_snapshot_registry(self.project).acquire(self.bug_id)
+        if self._snapshot is None:
+            raise FileNotFoundError(f"No snapshot stored for bug {self.bug_id}")
+
+    @property
+    def indexes(self):
+        return self.snapshot.get_index('lookup', self.build_lookup_indexes)
+
+    def build_lookup_indexes(self, snapshot):
+        paths_by_filename = {}
+        methods_by_name = {}
+        normalized_signatures = {}
+        for file_path in snapshot.paths:
+            paths_by_filename.setdefault(os.path.basename(file_path), []).append(file_path)
+            signatures = snapshot.get_signatures(file_path)
+            normalized_signatures[file_path] = [self.normalize_method_signature(signature) for signature in signatures]
+            for i, (signature, normalized_signature) in enumerate(zip(signatures, normalized_signatures[file_path])):
+                methods_by_name.setdefault(self.get_method_name(signature), []).append((file_path, normalized_signature, i))
+        return LookupIndexes(paths_by_filename, methods_by_name, normalized_signatures)
+
+    def build_filename_indexes(self, snapshot):
+        paths = list(snapshot.paths)
+        names = TrigramIndex([os.path.splitext(os.path.basename(file_path))[0] for file_path in paths])
+        directories = TrigramIndex([os.path.dirname(file_path) for file_path in paths])
+        return FilenameIndexes(paths, names, directories)
+
+    def build_paths_by_record(self, snapshot):
+        paths_by_record = {}
+        for file_path, record_hash in snapshot.manifest.items():
+            paths_by_record.setdefault(record_hash, []).append(file_path)
+        return paths_by_record
+
+    def build_signature_list(self, snapshot):
+        normalized_signatures = self.indexes.normalized_signatures
+        signatures = []
+        locations = []
+        for file_path in snapshot.paths:
+            signatures.extend(normalized_signatures[file_path])
+            locations.extend((file_path, i) for i in range(len(normalized_signatures[file_path])))
+        return signatures, locations
+
+    def close(self):
+        if self._snapshot is not None:
+            get_snapshot_registry(self.project).release(self.bug_id)
+            self._snapshot = None
 
     def process_suspicious_filenames(self, file_path, top_n=50):
         with open(file_path, 'r') as file:
@@ -44,20 +117,35 @@ class FileDataProcessor:
 
     def search_file(self, filename):
         processed_filename = self.extract_filename(filename)
-        matches = []
-        for file in self.file_level_data:
-            current_filename = file.get("filename")
-            if current_filename == processed_filename:
-                matches.append(
-                    {"filename": filename, "fully qualified filename": file.get("filepath")})
+        matches = [{"filename": filename, "fully qualified filename": file_path}
+                   for file_path in self.indexes.paths_by_filename.get(processed_filename, [])]
         if matches:
             return matches
         else:
             return {
                 "error": "File not found",
-                "filename": filename
+                "filename": filename,
+                "similar files": self.find_similar_files(filename)
             }
 
+    def find_similar_files(self, filename, top_n=5):
+        """Closest file names by trigram similarity, so a near miss costs no extra round trip"""
+        filename_indexes = self.snapshot.get_index('filenames', self.build_filename_indexes)
+        name = self.extract_filename(filename)[:-len('.java')]
+        query_path = filename[:-len('.java')] if filename.endswith('.java') else filename
+        directory = os.path.dirname(query_path.replace('\\', '/').replace('.', '/'))
+        scores = filename_indexes.names.score(name)
+        if directory:
+            scores = (1 - DIRECTORY_SCORE_WEIGHT) * scores + DIRECTORY_SCORE_WEIGHT * filename_indexes.directories.score(directory)
+
+        top_n = min(top_n, len(scores))
+        if top_n == 0:
+            return []
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = sorted(best, key=lambda position: (-scores[position], position))
+        return [{"fully qualified filename": filename_indexes.paths[position], "score": round(float(scores[position]), 3)}
+                for position in best if scores[position] > 0]
+
     def get_method_name(self, method_signature):
         try:
             index = method_signature.index("(")
@@ -67,15 +155,8 @@ class FileDataProcessor:
 
     def search_method(self, method_name):
         processed_method_name = self.get_method_name(method_name)
-        matches = []
-        for file in self.file_level_data:
-            methods = file.get("methods", [])
-            for method in methods:
-                method_signature = method["signature"]
-                current_method_name = self.get_method_name(method_signature)
-                if current_method_name == processed_method_name:
-                    matches.append({"filename": file.get(
-                        "filepath"), "method signature": self.normalize_method_signature(method_signature)})
+        matches = [{"filename": file_path, "method signature": normalized_signature}
+                   for file_path, normalized_signature, _ in self.indexes.methods_by_name.get(processed_method_name, [])]
         if matches:
             return matches
         else:
@@ -86,30 +167,19 @@ class FileDataProcessor:
 
     
     def normalize_method_signature(self, method_signature):
-        method_signature = re.sub(r'\s+', ' ', method_signature.strip())
-        method_signature = re.sub(r'\(\s+', '(', method_signature)
-        method_signature = re.sub(r'\s+\)', ')', method_signature)
+        method_signature = WHITESPACE_PATTERN.sub(' ', method_signature.strip())
+        method_signature = OPENING_PARENTHESIS_PATTERN.sub('(', method_signature)
+        method_signature = CLOSING_PARENTHESIS_PATTERN.sub(')', method_signature)
         return method_signature
 
 
     def get_method_signatures_of_a_file(self, fully_qualified_filename):
-        for file in self.file_level_data:
-            current_filepath = file.get("filepath")
-            if current_filepath == fully_qualified_filename:
-                methods = file.get("methods", [])
-                signatures = [self.normalize_method_signature(method["signature"]) for method in methods]
+        normalized_signatures = self.indexes.normalized_signatures
+        if fully_qualified_filename in normalized_signatures:
+            return {"filename": fully_qualified_filename, "method signatures": list(normalized_signatures[fully_qualified_filename])}
 
-                return {"filename": fully_qualified_filename, "method signatures": signatures}
-
-        matches = []
-        for file in self.file_level_data:
-            current_filename = file.get("filename")
-            if current_filename == self.extract_filename(fully_qualified_filename):
-                current_filepath = file.get("filepath")
-                methods = file.get("methods", [])
-                signatures = [self.normalize_method_signature(method["signature"]) for method in methods]
-                matches.append({"filename": current_filepath,
-                               "method signatures": signatures})
+        matches = [{"filename": file_path, "method signatures": list(normalized_signatures[file_path])}
+                   for file_path in self.indexes.paths_by_filename.get(self.extract_filename(fully_qualified_filename), [])]
 
         if (len(matches) > 1):
             print('multiple files matched!')
@@ -123,33 +193,35 @@ class FileDataProcessor:
                 "filename": fully_qualified_filename
             }
 
-    def match_method_body(self, methods, method_signature, filename, threshold=5):
-        for method in methods:
-            if self.normalize_method_signature(method["signature"]) == method_signature:
-                return [{"filename": filename, "method signature": method_signature, "method body": method["body"]}]
+    def locate_method(self, file_path, method_signature, threshold=5):
+        """Indexes of the file's methods with the signature, or else with the closest ones within the threshold"""
+        signatures = self.indexes.normalized_signatures[file_path]
+        if method_signature in signatures:
+            return [signatures.index(method_signature)]
 
+        # one vectorized call scores every signature; distances past the threshold come back as threshold + 1
         closest_matches = []
-        closest_distance = float('inf')
-
-        for method in methods:
-            distance = DamerauLevenshtein.distance(method_signature, self.normalize_method_signature(method["signature"]))
-
-            if distance <= threshold:
-                if distance < closest_distance:
-                    closest_matches = [method]
-                    closest_distance = distance
-                elif distance == closest_distance:
-                    closest_matches.append(method)
+        if signatures:
+            distances = process.cdist([method_signature], signatures, scorer=DamerauLevenshtein.distance,
+                                      score_cutoff=threshold, dtype=np.int32)[0]
+            if distances.min() <= threshold:
+                closest_matches = np.flatnonzero(distances == distances.min()).tolist()
         if len(closest_matches) > 1:
             print('multiple method signatures matched')
             # print(closest_matches)
+        return closest_matches
+
+    def match_method_body(self, file_path, method_signature, filename, threshold=5):
+        # only the signatures are compared; bodies are read from the store for the matches alone
+        signatures = self.indexes.normalized_signatures[file_path]
+        closest_matches = self.locate_method(file_path, method_signature, threshold)
         if closest_matches:
             return [
                 {
                     "filename": filename,
-                    "method signature": self.normalize_method_signature(match["signature"]),
-                    "method body": match["body"]
-                } for match in closest_matches
+                    "method signature": signatures[i],
+                    "method body": self.snapshot.get_method_body(file_path, i)
+                } for i in closest_matches
             ]
         else:
             return None
@@ -157,25 +229,225 @@ class FileDataProcessor:
     def get_method_body(self, fully_qualified_filename, method_signature):
         method_body = None
 
-        for file in self.file_level_data:
-            current_filepath = file.get("filepath")
-            if current_filepath == fully_qualified_filename:
-                methods = file.get("methods", [])
-                method_body = self.match_method_body(
-                    methods, method_signature, fully_qualified_filename)
-                if method_body:
-                    return method_body
+        if fully_qualified_filename in self.snapshot:
+            method_body = self.match_method_body(
+                fully_qualified_filename, method_signature, fully_qualified_filename)
+            if method_body:
+                return method_body
+
+        matches = []
+        for file_path in self.indexes.paths_by_filename.get(self.extract_filename(fully_qualified_filename), []):
+            partial_matches = self.match_method_body(
+                file_path, method_signature, file_path)
+            if partial_matches:
+                matches.extend(partial_matches)
+
+        if not matches and self.repository_search_budget:
+            matches = self.search_method_in_repository(method_signature)
+
+        if matches:
+            return matches
+        else:
+            return {
+                "error": "Problem in filename or method signature",
+                "filename": fully_qualified_filename,
+                "method signature": method_signature
+            }
+
+    def search_method_in_repository(self, method_signature, threshold=5, max_matches=10):
+        """Closest signatures anywhere in the repository, searched until the latency budget runs out"""
+        deadline = time.perf_counter() + self.repository_search_budget
+        # methods with the same name are the likeliest hits, so they are scored before the rest
+        candidates = self.indexes.methods_by_name.get(self.get_method_name(method_signature), [])
+        batches = [([signature for _, signature, _ in candidates], [(file_path, i) for file_path, _, i in candidates])]
+        signatures, locations = self.snapshot.get_index('signature_list', self.build_signature_list)
+        batches.extend((signatures[i:i + REPOSITORY_SEARCH_BATCH_SIZE], locations[i:i + REPOSITORY_SEARCH_BATCH_SIZE])
+                       for i in range(0, len(signatures), REPOSITORY_SEARCH_BATCH_SIZE))
+
+        closest_matches = {}
+        closest_distance = threshold + 1
+        for batch_signatures, batch_locations in batches:
+            if time.perf_counter() > deadline:
+                break
+            if not batch_signatures:
+                continue
+            distances = process.cdist([method_signature], batch_signatures, scorer=DamerauLevenshtein.distance,
+                                      score_cutoff=threshold, dtype=np.int32)[0]
+            batch_distance = distances.min()
+            if batch_distance < closest_distance:
+                closest_matches = {}
+                closest_distance = batch_distance
+            if batch_distance == closest_distance and batch_distance <= threshold:
+                for i in np.flatnonzero(distances == batch_distance):
+                    closest_matches.setdefault(batch_locations[i], batch_signatures[i])
+
+        return [
+            {
+                "filename": file_path,
+                "method signature": signature,
+                "method body": self.snapshot.get_method_body(file_path, i)
+            } for (file_path, i), signature in islice(closest_matches.items(), max_matches)
+        ]
+
+    def get_snippet(self, body, query, max_length=200):
+        lowered_query = query.lower()
+        if lowered_query not in body.lower():
+            return None
+        for line in body.splitlines():
+            if lowered_query in line.lower():
+                return line.strip()[:max_length]
+        return None
+
+    def get_token_snippet(self, body, tokens, max_length=200):
+        best_line = max(body.splitlines() or [''], key=lambda line: len(tokens & get_identifier_tokens(line)))
+        return best_line.strip()[:max_length]
+
+    def search_code(self, query, max_results=20):
+        """Methods whose bodies contain the query as a literal substring or share most of its identifiers"""
+        paths_by_record = self.snapshot.get_index('paths_by_record', self.build_paths_by_record)
+        snapshot_store = self.snapshot.snapshot_store
+        normalized_signatures = self.indexes.normalized_signatures
+        matches = {}
+
+        literal = query.strip().strip('"')
+        if len(literal) >= 3:
+            candidates = snapshot_store.find_literal_candidates(literal, paths_by_record)
+            candidate_paths = sorted(file_path for record_hash in candidates for file_path in paths_by_record[record_hash])
+            for file_path in candidate_paths[:MAX_LITERAL_CANDIDATES]:
+                if len(matches) >= max_results:
+                    break
+                for i in range(len(normalized_signatures[file_path])):
+                    snippet = self.get_snippet(self.snapshot.get_method_body(file_path, i), literal)
+                    if snippet is not None:
+                        matches[(file_path, i)] = snippet
+
+        tokens = get_identifier_tokens(query)
+        if tokens and len(matches) < max_results:
+            matched_tokens = {}
+            for token in tokens:
+                for record_hash, method_indexes in snapshot_store.find_code_token(token, paths_by_record).items():
+                    for file_path in paths_by_record[record_hash]:
+                        for i in method_indexes:
+                            matched_tokens[(file_path, i)] = matched_tokens.get((file_path, i), 0) + 1
+            # a method has to share at least half of the query's identifier tokens
+            required_tokens = (len(tokens) + 1) // 2
+            ranked = sorted((location for location, count in matched_tokens.items()
+                             if count >= required_tokens and location not in matches),
+                            key=lambda location: (-matched_tokens[location], location))
+            for file_path, i in ranked[:max_results - len(matches)]:
+                matches[(file_path, i)] = self.get_token_snippet(self.snapshot.get_method_body(file_path, i), tokens)
+
+        if matches:
+            return [
+                {
+                    "filename": file_path,
+                    "method signature": normalized_signatures[file_path][i],
+                    "snippet": snippet
+                } for (file_path, i), snippet in islice(matches.items(), max_results)
+            ]
+        else:
+            return {
+                "error": "No code matched the query",
+                "query": query
+            }
+
+    def count_parameters(self, method_signature):
+        """(number of parameters, whether the last one is varargs) of a signature"""
+        start = method_signature.find('(')
+        parameters = method_signature[start + 1:method_signature.rfind(')')].strip() if start >= 0 else ''
+        if not parameters:
+            return 0, False
+        # commas inside generics or annotation arguments do not separate parameters
+        depth = 0
+        count = 1
+        for character in parameters:
+            if character in '<(':
+                depth += 1
+            elif character in '>)':
+                depth -= 1
+            elif character == ',' and depth == 0:
+                count += 1
+        return count, '...' in parameters
+
+    def accepts_arguments(self, method_signature, arguments):
+        count, varargs = self.count_parameters(method_signature)
+        return arguments >= count - 1 if varargs else arguments == count
+
+    def find_callers(self, method, max_results=50):
+        """Methods calling the method, by name and, when a signature is given, by number of arguments"""
+        paths_by_record = self.snapshot.get_index('paths_by_record', self.build_paths_by_record)
+        arguments = None
+        if '(' in method:
+            count, varargs = self.count_parameters(method)
+            # a varargs method can be called with any number of arguments past the fixed ones
+            arguments = None if varargs else count
+        # calls are indexed by the bare method name, so qualifiers like Foo.bar or Foo#bar and modifiers are dropped
+        method_name = re.split(r'[\s.#]+', self.get_method_name(method).strip())[-1]
+        callers = self.snapshot.snapshot_store.find_references('call', method_name, paths_by_record, arguments)
+
+        normalized_signatures = self.indexes.normalized_signatures
+        locations = sorted((file_path, i) for record_hash, method_indexes in callers.items()
+                           for file_path in paths_by_record[record_hash] for i in method_indexes)
+        if locations:
+            return [{"filename": file_path, "method signature": normalized_signatures[file_path][i]}
+                    for file_path, i in locations[:max_results]]
+        else:
+            return {
+                "error": "No callers found",
+                "method": method
+            }
+
+    def get_declaring_paths(self, class_name):
+        paths_by_record = self.snapshot.get_index('paths_by_record', self.build_paths_by_record)
+        return {file_path for record_hash in self.snapshot.snapshot_store.find_references('class', class_name, paths_by_record)
+                for file_path in paths_by_record[record_hash]}
+
+    def resolve_call(self, file_path, name, arguments, receiver, declaring_paths, max_candidates=5):
+        """Methods of the snapshot a call can land on, narrowed by its receiver where that is telling"""
+        candidates = [(candidate_path, signature) for candidate_path, signature, _ in self.indexes.methods_by_name.get(name, [])
+                      if self.accepts_arguments(signature, arguments)]
+        if receiver is None or receiver == 'this':
+            preferred_paths = {file_path}
+        elif receiver[:1].isupper():
+            # a capitalized receiver is most likely a class, as in a static call
+            if receiver not in declaring_paths:
+                declaring_paths[receiver] = self.get_declaring_paths(receiver)
+            preferred_paths = declaring_paths[receiver]
+        else:
+            preferred_paths = set()
+        preferred = [candidate for candidate in candidates if candidate[0] in preferred_paths]
+        return [{"filename": candidate_path, "method signature": signature}
+                for candidate_path, signature in (preferred or candidates)[:max_candidates]]
 
+    def find_callees(self, fully_qualified_filename, method_signature):
+        """Calls and field accesses of a method, with the methods of the snapshot each call may resolve to"""
+        file_paths = [fully_qualified_filename] if fully_qualified_filename in self.snapshot else \
+            self.indexes.paths_by_filename.get(self.extract_filename(fully_qualified_filename), [])
+        method_signature = self.normalize_method_signature(method_signature)
+        snapshot_store = self.snapshot.snapshot_store
+        declaring_paths = {}
         matches = []
-        for file in self.file_level_data:
-            current_filename = file.get("filename")
-            if current_filename == self.extract_filename(fully_qualified_filename):
-                current_filepath = file.get("filepath")
-                methods = file.get("methods", [])
-                partial_matches = self.match_method_body(
-                    methods, method_signature, current_filepath)
-                if partial_matches:
-                    matches.extend(partial_matches)
+        for file_path in file_paths:
+            method_indexes = self.locate_method(file_path, method_signature)
+            if not method_indexes:
+                continue
+            references = snapshot_store.load_references([self.snapshot.manifest[file_path]])[self.snapshot.manifest[file_path]]
+            for i in method_indexes:
+                method_references = references['methods'][i]
+                matches.append({
+                    "filename": file_path,
+                    "method signature": self.indexes.normalized_signatures[file_path][i],
+                    "calls": [
+                        {
+                            "method": name,
+                            "receiver": receiver,
+                            "arguments": arguments,
+                            "declared in": self.resolve_call(file_path, name, arguments, receiver, declaring_paths)
+                        } for name, arguments, receiver in method_references['calls']
+                    ],
+                    "field accesses": [name if receiver is None else f"{receiver}.{name}"
+                                       for name, receiver in method_references['fields']]
+                })
 
         if matches:
             return matches
@@ -1,72 +1,336 @@
+import difflib
+import threading
+from collections import OrderedDict
 import tree_sitter_java as tsjava
 from tree_sitter import Language, Parser
 
+# one query finds every node extraction needs; tree-sitter walks the tree in C and
+# returns the captures in document order, outer nodes before the nodes they contain
+EXTRACTION_QUERY = """
+(package_declaration (scoped_identifier) @package)
+(method_declaration) @method
+(constructor_declaration) @method
+(class_declaration) @class
+(interface_declaration) @class
+(enum_declaration) @class
+(record_declaration) @class
+(method_invocation) @call
+(object_creation_expression) @creation
+(field_access) @field
+"""
+# the same patterns split in two, for re-extracting only the methods an edit touched
+DECLARATION_QUERY = """
+(package_declaration (scoped_identifier) @package)
+(method_declaration) @method
+(constructor_declaration) @method
+(class_declaration) @class
+(interface_declaration) @class
+(enum_declaration) @class
+(record_declaration) @class
+"""
+REFERENCE_QUERY = """
+(method_invocation) @call
+(object_creation_expression) @creation
+(field_access) @field
+"""
+COMMENT_TYPES = ('line_comment', 'block_comment')
+RECEIVER_TYPES = ('identifier', 'this', 'super', 'field_access')
+
+thread_local_parsers = threading.local()
+
+def compile_queries(language):
+    return {name: language.query(query) for name, query in
+            (('extraction', EXTRACTION_QUERY), ('declaration', DECLARATION_QUERY), ('reference', REFERENCE_QUERY))}
+
 def initialize_parser():
-    global parser
+    global parser, queries
     parser = Parser()
     JAVA_LANGUAGE = Language(tsjava.language(), 'java')
     parser.set_language(JAVA_LANGUAGE)
+    queries = compile_queries(JAVA_LANGUAGE)
+
+def get_parser():
+    # tree-sitter parsers are not thread-safe, so extra threads each get their own
+    if threading.current_thread() is threading.main_thread():
+        return parser
+    if not hasattr(thread_local_parsers, 'parser'):
+        thread_language = Language(tsjava.language(), 'java')
+        thread_parser = Parser()
+        thread_parser.set_language(thread_language)
+        thread_local_parsers.parser = thread_parser
+        thread_local_parsers.queries = compile_queries(thread_language)
+    return thread_local_parsers.parser
 
-def extract_node_text(node, field_name, default):
+def get_query(name):
+    if threading.current_thread() is threading.main_thread():
+        return queries[name]
+    get_parser()
+    return thread_local_parsers.queries[name]
+
+def get_node_text(source, node):
+    # slicing the source the tree was parsed from skips a bytes copy per node
+    return source[node.start_byte:node.end_byte].decode('utf-8')
+
+def extract_node_text(source, node, field_name, default):
     field_node = node.child_by_field_name(field_name)
-    return field_node.text.decode('utf-8') if field_node else default
+    return get_node_text(source, field_node) if field_node else default
 
-def get_method_signature(method_declaration_node):
-    method_name = extract_node_text(method_declaration_node, 'name', '<unknown>')
-    parameters = extract_node_text(method_declaration_node, 'parameters', '()')
+def get_method_signature(source, method_declaration_node):
+    method_name = extract_node_text(source, method_declaration_node, 'name', '<unknown>')
+    parameters = extract_node_text(source, method_declaration_node, 'parameters', '()')
 
     return f'{method_name}{parameters}'
 
-def get_method_body(method_declaration_node):
-    return method_declaration_node.text.decode('utf-8')
+def get_receiver(source, node):
+    # names are kept as written; any other expression (a call chain, a cast, ...) is only marked
+    object_node = node.child_by_field_name('object')
+    if object_node is None:
+        return None
+    if object_node.type in RECEIVER_TYPES:
+        return get_node_text(source, object_node)
+    return '<expression>'
+
+def count_arguments(node):
+    arguments_node = node.child_by_field_name('arguments')
+    if arguments_node is None:
+        return 0
+    return sum(1 for child in arguments_node.named_children if child.type not in COMMENT_TYPES)
+
+def get_creation_reference(source, node):
+    type_node = node.child_by_field_name('type')
+    if type_node is None:
+        return None
+    # generic and qualified types are called by their simple name, like the constructor
+    type_name = get_node_text(source, type_node).split('<')[0].split('.')[-1]
+    return type_name, count_arguments(node), None
+
+def add_reference(source, node, capture_name, enclosing_references):
+    if capture_name == 'field':
+        field = (extract_node_text(source, node, 'field', '<unknown>'), get_receiver(source, node))
+        for references in enclosing_references:
+            references['fields'].setdefault(field, None)
+        return
+    if capture_name == 'call':
+        call = (extract_node_text(source, node, 'name', '<unknown>'), count_arguments(node), get_receiver(source, node))
+    else:
+        call = get_creation_reference(source, node)
+        if call is None:
+            return
+    for references in enclosing_references:
+        references['calls'].setdefault(call, None)
+
+def get_package(source, node, root_node):
+    # only a declaration directly under the root names the package; the root is
+    # an ERROR node rather than a program when the file does not parse cleanly
+    return get_node_text(source, node) if node.parent.parent == root_node else None
+
+def extract_all(source, root_node, extraction):
+    """One pass of the extraction query, filling extraction = (package, methods, classes, references by method)"""
+    # methods whose span contains the current capture; a nested method's references
+    # also belong to the methods around it, as its body does
+    enclosing_methods = []
+    for node, capture_name in get_query('extraction').captures(root_node):
+        while enclosing_methods and enclosing_methods[-1][0] <= node.start_byte:
+            enclosing_methods.pop()
+
+        if capture_name == 'package':
+            extraction[0] = get_package(source, node, root_node) or extraction[0]
+        elif capture_name == 'method':
+            method_signature = get_method_signature(source, node)
+            extraction[1].append((method_signature, get_node_text(source, node)))
+            extraction[3].append({'calls': {}, 'fields': {}})
+            enclosing_methods.append((node.end_byte, extraction[3][-1]))
+        elif capture_name == 'class':
+            extraction[2].append(extract_node_text(source, node, 'name', '<unknown>'))
+        elif enclosing_methods:
+            add_reference(source, node, capture_name, [references for _, references in enclosing_methods])
+
+def extract_changed(source, root_node, previous_file, extraction):
+    """Fill extraction from the declarations of the tree, re-collecting references only for the methods
+    whose text differs from the previous version of the file; the others keep their previous references"""
+    _, previous_methods, previous_references = previous_file
+    changed_methods = []
+    for node, capture_name in get_query('declaration').captures(root_node):
+        if capture_name == 'package':
+            extraction[0] = get_package(source, node, root_node) or extraction[0]
+        elif capture_name == 'method':
+            method_signature = get_method_signature(source, node)
+            method_body = get_node_text(source, node)
+            extraction[1].append((method_signature, method_body))
+            if previous_methods.get(method_signature) == method_body:
+                extraction[3].append(previous_references['methods'][method_signature])
+            else:
+                extraction[3].append({'calls': {}, 'fields': {}})
+                changed_methods.append((node.start_byte, node.end_byte, extraction[3][-1]))
+        elif capture_name == 'class':
+            extraction[2].append(extract_node_text(source, node, 'name', '<unknown>'))
+
+    # a method containing a changed one has changed too, so the outermost spans cover every reference needed
+    outermost_spans = []
+    for start_byte, end_byte, _ in changed_methods:
+        if not outermost_spans or start_byte >= outermost_spans[-1][1]:
+            outermost_spans.append((start_byte, end_byte))
+    next_method = 0
+    enclosing_methods = []
+    for start_byte, end_byte in outermost_spans:
+        for node, capture_name in get_query('reference').captures(root_node, start_byte=start_byte, end_byte=end_byte):
+            # nodes merely overlapping the span (an anonymous class argument) start before every changed method
+            while next_method < len(changed_methods) and changed_methods[next_method][0] <= node.start_byte:
+                while enclosing_methods and enclosing_methods[-1][0] <= changed_methods[next_method][0]:
+                    enclosing_methods.pop()
+                enclosing_methods.append((changed_methods[next_method][1], changed_methods[next_method][2]))
+                next_method += 1
+            while enclosing_methods and enclosing_methods[-1][0] <= node.start_byte:
+                enclosing_methods.pop()
+            if enclosing_methods:
+                add_reference(source, node, capture_name, [references for _, references in enclosing_methods])
+
+def extract_from_tree(source, root_node, previous_file=None):
+    """Return (package, {signature: body}, references) of a parsed file; references hold the declared
+    class names and, per signature, the calls and field accesses made in the method"""
+    extraction = [None, [], [], []]
+    try:
+        if root_node is not None:
+            if previous_file is None:
+                extract_all(source, root_node, extraction)
+            else:
+                extract_changed(source, root_node, previous_file, extraction)
+    except Exception as e:
+        print(f"Error processing: {e}")
+
+    package, method_list, classes, references_list = extraction
+    methods = {}
+    method_references = {}
+    # a repeated signature keeps its first position and its last body, as in a dict filled in order
+    for (method_signature, method_body), references in zip(method_list, references_list):
+        methods[method_signature] = method_body
+        method_references[method_signature] = references
+    references = {
+        'classes': list(dict.fromkeys(classes)),
+        'methods': {
+            signature: references if isinstance(references['calls'], list) else {
+                'calls': [list(call) for call in references['calls']],
+                'fields': [list(field) for field in references['fields']]
+            } for signature, references in method_references.items()
+        }
+    }
+    return package, methods, references
 
 def extract_package_and_methods(content):
+    """Return (package, {signature: body}, references) of a file's content"""
     try:
-        root_node = parse_file(content)
-        methods = {}
-        package = None
-        if(root_node is not None):
-            for node in root_node.children:
-                if node.type == 'package_declaration':
-                    for child in node.children:
-                        if child.type == 'scoped_identifier':
-                            package = child.text.decode('utf-8')
-            
-            def traverse(node):
-                if node.type == 'method_declaration' or node.type == 'constructor_declaration':
-                        method_signature = get_method_signature(node)
-                        method_body = get_method_body(node)
-                        methods[method_signature] = method_body
-                for child in node.children:
-                    traverse(child)
-
-            traverse(root_node)
-        return package, methods
-    
+        source, root_node = parse_file(content)
     except Exception as e:
         print(f"Error processing: {e}")
-        return package, methods
+        source, root_node = None, None
+    return extract_from_tree(source, root_node)
 
-def extract_node_text(node, field_name, default):
-    field_node = node.child_by_field_name(field_name)
-    return field_node.text.decode('utf-8') if field_node else default
+def split_lines(source):
+    # tree-sitter counts rows by '\n' alone, so lines are split the same way
+    lines = source.split(b'\n')
+    return [line + b'\n' for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
 
-def get_method_signature(method_declaration_node):
-    method_name = extract_node_text(method_declaration_node, 'name', '<unknown>')
-    parameters = extract_node_text(method_declaration_node, 'parameters', '()')
+def get_end_point(start_row, lines):
+    if not lines:
+        return (start_row, 0)
+    if lines[-1].endswith(b'\n'):
+        return (start_row + len(lines), 0)
+    return (start_row + len(lines) - 1, len(lines[-1]))
 
-    return f'{method_name}{parameters}'
+def get_common_prefix_length(first, second):
+    # binary search over slice comparisons, which run in C
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def get_tree_edits(previous_source, source):
+    """Line-level edits turning previous_source into source, last one first, as Tree.edit arguments"""
+    # only the lines between the common prefix and suffix are diffed
+    prefix_length = previous_source.rfind(b'\n', 0, get_common_prefix_length(previous_source, source)) + 1
+    suffix_length = get_common_prefix_length(previous_source[prefix_length:][::-1], source[prefix_length:][::-1])
+    # the middle is widened to whole lines so the diff below stays line-based
+    previous_end = previous_source.find(b'\n', len(previous_source) - suffix_length)
+    end = source.find(b'\n', len(source) - suffix_length)
+    previous_middle = previous_source[prefix_length:len(previous_source) if previous_end < 0 else previous_end + 1]
+    middle = source[prefix_length:len(source) if end < 0 else end + 1]
+    if previous_middle == middle:
+        return
+    first_row = previous_source.count(b'\n', 0, prefix_length)
+
+    previous_lines = split_lines(previous_middle)
+    lines = split_lines(middle)
+    previous_offsets = [prefix_length]
+    for line in previous_lines:
+        previous_offsets.append(previous_offsets[-1] + len(line))
+    offsets = [prefix_length]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    opcodes = difflib.SequenceMatcher(None, previous_lines, lines, autojunk=False).get_opcodes()
+    # applied from the end, every edit's start is still where it was in the previous source
+    for tag, i1, i2, j1, j2 in reversed(opcodes):
+        if tag == 'equal':
+            continue
+        start_byte = previous_offsets[i1]
+        yield {
+            'start_byte': start_byte,
+            'old_end_byte': previous_offsets[i2],
+            'new_end_byte': start_byte + offsets[j2] - offsets[j1],
+            'start_point': (first_row + i1, 0),
+            'old_end_point': get_end_point(first_row + i1, previous_lines[i1:i2]),
+            'new_end_point': get_end_point(first_row + i1, lines[j1:j2])
+        }
+
+def parse_and_extract(content, previous=None):
+    """Return (source, tree, parsed file) of the content.
+
+    previous is the (source, tree, parsed file) of an earlier version of the same file: its tree is
+    edited and handed to tree-sitter, which reuses the unchanged parts, and the methods whose text is
+    unchanged keep their extracted references. The previous tree is modified in the process.
+    """
+    if (content is None) or (len(content) == 0):
+        return None, None, extract_from_tree(None, None)
+    source = bytes(content, "utf8")
+    previous_file = None
+    if previous is not None and previous[1] is not None:
+        previous_source, previous_tree, previous_file = previous
+        for edit in get_tree_edits(previous_source, source):
+            previous_tree.edit(**edit)
+        tree = get_parser().parse(source, previous_tree)
+    else:
+        tree = get_parser().parse(source)
+    return source, tree, extract_from_tree(source, tree.root_node, previous_file)
+
+class SyntaxTreeCache:
+    """The syntax trees of recently parsed file versions, keyed by blob id and bounded by an LRU"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def take(self, blob_id):
+        # editing a tree changes it in place, so an entry is handed out only once
+        return self._entries.pop(blob_id, None) if blob_id is not None else None
+
+    def put(self, blob_id, source, tree, parsed_file):
+        self._entries[blob_id] = (source, tree, parsed_file)
+        self._entries.move_to_end(blob_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
 
-def get_method_body(method_declaration_node):
-    return method_declaration_node.text.decode('utf-8')
+    def __len__(self):
+        return len(self._entries)
 
 
-def parse_file(content): 
-    root_node = None
+def parse_file(content):
+    """Return (source bytes, root node), or (None, None) for an empty file"""
     if (content is not None) and (len(content) != 0):
-        tree = parser.parse(bytes(content, "utf8"))
-        root_node = tree.root_node
+        source = bytes(content, "utf8")
+        tree = get_parser().parse(source)
+        return source, tree.root_node
 
-    return root_node
-    
-    
\ No newline at end of file
+    return None, None
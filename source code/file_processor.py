@@ -1,237 +1,446 @@
 import os
 import json
+import multiprocessing
+from collections import deque, Counter
+from itertools import islice, chain
+from concurrent.futures import ProcessPoolExecutor
 from config import Config
 from file_parser import *
 from collection_handler import *
 from datetime import datetime
-from db_handler import create_file_collection, delete_file_collection, get_file_collection
+from db_handler import create_file_collection, delete_file_collection, get_file_collection, open_file_collection, load_index_state, list_snapshots, load_snapshot
+from parse_cache import get_parse_cache
+from snapshot_store import get_snapshot_store
+from git_object_store import list_java_blobs, read_blobs, diff_trees, get_blob_reader
 from utils import *
 
-def get_file_content(repo_path,file_path):
+# syntax trees kept for incremental re-parsing of the files the next commits modify
+SYNTAX_TREE_CACHE_SIZE = 256
+# files whose cache lookups and blob reads are done together while rebuilding from a tree
+BLOB_WINDOW_SIZE = 256
+
+worker_pool = None
+processing_costs = {}
+filewise_chunk_ids = {}
+syntax_tree_cache = SyntaxTreeCache(SYNTAX_TREE_CACHE_SIZE)
+
+def get_file_bytes(repo_path, file_path):
     full_path = repo_path / file_path
-    with open((full_path), encoding="utf8", errors="ignore") as file:
-        file_content = file.read()
-    return file_content
+    with open(full_path, 'rb') as file:
+        return file.read()
 
-def process_files_from_directory(repo_path):
-    # starting_time = datetime.now()
-    global filewise_method_data
-    filewise_method_data = {}
-    
-    delete_file_collection()
-    file_collection = create_file_collection()
+def chunk_files_data(files):
+    """Chunk a batch of (file_path, package, methods_dict, references) files with one pass of the tokenizer"""
+    file_entries = []
+    file_texts = []
+    for file_path, package, methods_dict, references in files:
+        if len(methods_dict)>0 and (package is not None):
+            methods = [{'signature': signature, 'body': body} for signature, body in methods_dict.items()]
+            # references of the i-th method sit at position i, next to the class names of the file
+            file_references = {'classes': references['classes'],
+                               'methods': [references['methods'][signature] for signature in methods_dict]}
+            file_entries.append({'package': package, 'methods': methods, 'references': file_references})
+            file_texts.append('\n'.join(method['body'] for method in methods).strip())
+        else:
+            file_entries.append(None)
+    chunks_of_files = iter(get_chunks_of_entities(file_texts))
 
-    documents = []
-    metadatas = []
+    results = []
+    for (file_path, *_), file_entry in zip(files, file_entries):
+        if file_entry is None:
+            results.append((None, [], []))
+            continue
+        documents = ['file: ' + file_path + '\n' + s for s in next(chunks_of_files)]
+        metadatas = [{"file": file_path} for _ in documents]
+        results.append((file_entry, documents, metadatas))
+    return results
+
+def initialize_worker(project, embedding_type):
+    config = Config()
+    config.set_project(project)
+    config.set_embedding_type(embedding_type)
+    initialize_parser()
+
+def process_files_in_worker(tasks):
+    parsed_files = []
+    for file_path, file_content, parsed_file in tasks:
+        if parsed_file is None:
+            parsed_file = extract_package_and_methods(file_content)
+        parsed_files.append(parsed_file)
+    chunked_files = chunk_files_data([(task[0], *parsed_file) for task, parsed_file in zip(tasks, parsed_files)])
+    return [(parsed_file, *chunked_file) for parsed_file, chunked_file in zip(parsed_files, chunked_files)]
+
+def batch_tasks(tasks, batch_size):
+    tasks = iter(tasks)
+    while True:
+        batch = list(islice(tasks, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def read_files_for_processing(repo_path, file_paths, uncached_blob_hashes):
+    # cache lookups stay in this process; workers only see content that still needs parsing
+    parse_cache = get_parse_cache()
+    for file_path in file_paths:
+        file_bytes = get_file_bytes(repo_path, file_path)
+        # decoded like a blob read from git, so both paths parse a file the same way under the same key
+        file_content = file_bytes.decode('utf-8', errors='ignore')
+        parsed_file = None
+        if parse_cache is not None:
+            blob_hash = calculate_blob_hash(file_bytes)
+            parsed_file = parse_cache.get(blob_hash)
+            if parsed_file is None:
+                uncached_blob_hashes[file_path] = blob_hash
+            else:
+                file_content = None
+        yield file_path, file_content, parsed_file
+
+def get_worker_pool():
+    global worker_pool
+    if worker_pool is None:
+        config = Config()
+        # spawn instead of fork: the parent already holds chromadb/torch threads
+        worker_pool = ProcessPoolExecutor(
+            max_workers=config.get_num_workers(),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=initialize_worker,
+            initargs=(config.get_project(), config.get_embedding_type())
+        )
+    return worker_pool
+
+def map_in_worker_pool(tasks, batch_size, max_pending_batches):
+    """Ordered pool map that submits lazily, so only a few batches of file contents are ever in flight"""
+    worker_pool = get_worker_pool()
+    batches = batch_tasks(tasks, batch_size)
+    pending_batches = deque()
+    while True:
+        for batch in islice(batches, max_pending_batches - len(pending_batches)):
+            pending_batches.append(worker_pool.submit(process_files_in_worker, batch))
+        if not pending_batches:
+            return
+        yield from pending_batches.popleft().result()
+
+def shutdown_worker_pool():
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.shutdown()
+        worker_pool = None
+
+def list_java_files(repo_path):
+    file_paths = []
     for root, dirs, files in os.walk(repo_path):
         relative_root = os.path.relpath(root, repo_path)
         for file in files:
             if file.endswith(".java"):
                 file_path = os.path.join(relative_root, file)
-                file_path = file_path.replace("\\", "/")
-                file_content = get_file_content(repo_path, file_path)
-                # print("processing", file_path)
-                package, methods_dict = extract_package_and_methods(file_content)
-                if len(methods_dict)>0 and (package is not None):
-                    file_data = ''
-                    filewise_method_data[file_path] = {
-                        'package': package,
-                        'methods': []
-                    }
-                
-                    for signature, body in methods_dict.items():
-                        filewise_method_data[file_path]['methods'].append({
-                            'signature': signature,
-                            'body': body
-                        })
-                        file_data = file_data + '\n' + body
-                    # print("entities", len(methods_dict))
-                    chunks = get_chunks(file_data.strip())
-                    updated_chunks = ['file: ' + file_path + '\n' + s for s in chunks]
-                    documents.extend(updated_chunks)
-                    list_of_metadata = [{"file": file_path} for _ in updated_chunks]
-                    metadatas.extend(list_of_metadata)
-
-                # for chunk in chunks:
-                #     print(chunk)
-                #     print("*************")
+                file_paths.append(file_path.replace("\\", "/"))
+    return file_paths
+
+def read_blobs_for_processing(repo_path, java_blobs, uncached_blob_hashes):
+    # the tree already names each blob, so cached files are never read from git at all;
+    # files go through in windows, so only one window of sources is held at a time
+    parse_cache = get_parse_cache()
+    blob_reader = get_blob_reader(repo_path)
+    entries = iter(java_blobs.items())
+    while True:
+        window = list(islice(entries, BLOB_WINDOW_SIZE))
+        if not window:
+            return
+        parsed_files = [parse_cache.get(blob_id) if parse_cache is not None else None for _, blob_id in window]
+        remaining_uses = Counter()
+        for (file_path, blob_id), parsed_file in zip(window, parsed_files):
+            if parsed_file is None:
+                uncached_blob_hashes[file_path] = blob_id
+                remaining_uses[blob_id] += 1
+        file_contents = dict(blob_reader.read_many(remaining_uses))
+        for (file_path, blob_id), parsed_file in zip(window, parsed_files):
+            if parsed_file is not None:
+                yield file_path, None, parsed_file
+                continue
+            # files sharing a blob read it once; it is dropped after its last use
+            remaining_uses[blob_id] -= 1
+            file_content = file_contents[blob_id] if remaining_uses[blob_id] else file_contents.pop(blob_id)
+            yield file_path, file_content, None
+
+def get_chunk_ids(file_path, documents):
+    return list(dict.fromkeys(calculate_hash(file_path + document) for document in documents))
+
+def build_file_index(file_paths, tasks, uncached_blob_hashes):
+    global filewise_method_data, filewise_chunk_ids
+    filewise_method_data = {}
+    filewise_chunk_ids = {}
+    
+    delete_file_collection()
+    file_collection = create_file_collection()
+
+    num_workers = Config().get_num_workers()
+    batch_size = max(1, min(64, len(file_paths) // (num_workers * 8)))
+    if num_workers > 1:
+        results = map_in_worker_pool(tasks, batch_size, num_workers * 2)
+    else:
+        results = chain.from_iterable(map(process_files_in_worker, batch_tasks(tasks, batch_size)))
+
+    # results arrive in file_paths order either way, so both paths build the same collection;
+    # chunks stream into the embedding pipeline instead of piling up for the whole repository
+    parse_cache = get_parse_cache()
+    pipeline = IngestionPipeline(file_collection)
+    try:
+        for file_path, (parsed_file, file_entry, file_documents, file_metadatas) in zip(file_paths, results):
+            if parse_cache is not None and file_path in uncached_blob_hashes:
+                parse_cache.put(uncached_blob_hashes[file_path], *parsed_file)
+            if file_entry is not None:
+                filewise_method_data[file_path] = file_entry
+                chunk_ids = [calculate_hash(file_path + document) for document in file_documents]
+                filewise_chunk_ids[file_path] = list(dict.fromkeys(chunk_ids))
+                pipeline.add(chunk_ids, file_documents, file_metadatas)
+    finally:
+        pipeline.close()
+    if parse_cache is not None:
+        parse_cache.flush()
+
+def process_files_from_directory(repo_path):
+    # starting_time = datetime.now()
+    file_paths = list_java_files(repo_path)
+    uncached_blob_hashes = {}
+    tasks = read_files_for_processing(repo_path, file_paths, uncached_blob_hashes)
+    build_file_index(file_paths, tasks, uncached_blob_hashes)
     # ending_time = datetime.now()
     # print("file processing time:", ending_time-starting_time)
-    insert_into_file_collection(file_collection, documents, metadatas)
+
+def process_files_from_commit(repo_path, commit, java_blobs=None):
+    """Index a commit straight from the git object store, leaving the working tree untouched"""
+    if java_blobs is None:
+        java_blobs = list_java_blobs(repo_path, commit)
+    uncached_blob_hashes = {}
+    tasks = read_blobs_for_processing(repo_path, java_blobs, uncached_blob_hashes)
+    build_file_index(list(java_blobs), tasks, uncached_blob_hashes)
+
+def record_processing_cost(mode, seconds, num_files):
+    if num_files == 0:
+        return
+    cost = seconds / num_files
+    previous_cost = processing_costs.get(mode)
+    processing_costs[mode] = cost if previous_cost is None else 0.7 * previous_cost + 0.3 * cost
+
+def should_rebuild(num_changes, num_files):
+    # stay incremental until both paths have been timed at least once
+    if 'rebuild' not in processing_costs or 'incremental' not in processing_costs:
+        return False
+    estimated_incremental_cost = processing_costs['incremental'] * num_changes
+    estimated_rebuild_cost = processing_costs['rebuild'] * num_files
+    return estimated_incremental_cost > estimated_rebuild_cost
+
+def rebuild_file_index(git_repo, current_commit, current_tree):
+    starting_time = datetime.now()
+    process_files_from_commit(git_repo.path, current_commit, current_tree)
+    record_processing_cost('rebuild', (datetime.now() - starting_time).total_seconds(), len(current_tree))
 
 def manage_file_processing(git_repo, bug_id, prev_commit, current_commit):
+    current_tree = list_java_blobs(git_repo.path, current_commit)
     if(prev_commit==""):
-        git_repo.checkout(current_commit)
-        # time.sleep(30)
-        process_files_from_directory(git_repo.path)
+        rebuild_file_index(git_repo, current_commit, current_tree)
     else:
-        modified_files = git_repo.diff(from_commit_id = prev_commit, to_commit_id = current_commit)
-        if(2*len(modified_files)>=len(filewise_method_data)):
-            git_repo.checkout(current_commit)
-            # time.sleep(30)
-            process_files_from_directory(git_repo.path)
+        file_changes = diff_trees(list_java_blobs(git_repo.path, prev_commit), current_tree)
+        if should_rebuild(len(file_changes), len(current_tree)):
+            rebuild_file_index(git_repo, current_commit, current_tree)
         else:
-            process_files_from_git_diff(modified_files)
+            starting_time = datetime.now()
+            process_files_from_git_diff(git_repo.path, file_changes)
+            record_processing_cost('incremental', (datetime.now() - starting_time).total_seconds(), len(file_changes))
     store_file_data(bug_id)
 
-def process_files_from_git_diff(modified_files):
+def parse_changed_blobs(repo_path, file_changes):
+    """Parse each new blob once, reading from the object store only what the parse cache lacks.
+
+    A file whose previous version was parsed recently is re-parsed incrementally from that
+    version's syntax tree, with only its edited methods re-extracted.
+    """
+    parse_cache = get_parse_cache()
+    parsed_files = {}
+    uncached_file_changes = {}
+    for file_change in file_changes:
+        blob_id = file_change.new_blob_id
+        if blob_id in parsed_files or blob_id in uncached_file_changes:
+            continue
+        parsed_file = parse_cache.get(blob_id) if parse_cache is not None else None
+        if parsed_file is None:
+            uncached_file_changes[blob_id] = file_change
+        else:
+            parsed_files[blob_id] = parsed_file
+
+    parse_counts = {'cached': len(parsed_files), 'incremental': 0, 'full': 0}
+    for blob_id, file_content in read_blobs(repo_path, list(uncached_file_changes)).items():
+        previous = syntax_tree_cache.take(uncached_file_changes[blob_id].old_blob_id)
+        source, tree, parsed_files[blob_id] = parse_and_extract(file_content, previous)
+        parse_counts['incremental' if previous is not None else 'full'] += 1
+        if tree is not None:
+            syntax_tree_cache.put(blob_id, source, tree, parsed_files[blob_id])
+        if parse_cache is not None:
+            parse_cache.put(blob_id, *parsed_files[blob_id])
+    if parse_cache is not None:
+        parse_cache.flush()
+    print('parses', parse_counts)
+    return parsed_files
+
+def get_chunk_header(file_path):
+    return 'file: ' + file_path + '\n'
+
+def process_files_from_git_diff(repo_path, file_changes):
     documents = []
     metadatas = []
+    moved_chunks = {'ids': [], 'documents': [], 'metadatas': [], 'embeddings': []}
+    vanished_ids = []
+    chunk_counts = {'reused': 0, 'embedded': 0, 'deleted': 0}
 
-    modified_java_files = []
-    for modified_file in modified_files:
-        if modified_file.filename.endswith(".java"):
-            if modified_file.change_type.name == "DELETE":
-                modified_java_files.insert(0,modified_file)
-            else:
-                modified_java_files.append(modified_file)
+    # every file whose content changed is parsed and chunked in one batch up front
+    changed_files = [file_change for file_change in file_changes
+                     if file_change.change_type != "DELETE" and file_change.new_blob_id != file_change.old_blob_id]
+    parsed_files = parse_changed_blobs(repo_path, changed_files)
+    chunked_files = dict(zip(
+        [file_change.new_path for file_change in changed_files],
+        chunk_files_data([(file_change.new_path, *parsed_files[file_change.new_blob_id]) for file_change in changed_files])))
 
     file_collection = get_file_collection()
-    for modified_file in modified_java_files:
-        if modified_file.change_type.name == "ADD":
-            # print(modified_file.source_code)
-            file_path = modified_file.new_path
-            file_path = file_path.replace("\\", "/")
-            file_content = modified_file.source_code
+    # one id-based fetch covers the stored chunks of every renamed file
+    renamed_chunks = get_chunks_by_id(file_collection, [
+        chunk_id for file_change in file_changes if file_change.change_type == "RENAME"
+        for chunk_id in filewise_chunk_ids.get(file_change.old_path, [])])
+
+    for file_change in file_changes:
+        if file_change.change_type == "ADD":
+            file_path = file_change.new_path
             # print("Added file:", file_path)
-            package, methods_dict = extract_package_and_methods(file_content)
-            if len(methods_dict)>0 and (package is not None):
-                file_data = ''
-                filewise_method_data[file_path] = {
-                    'package': package,
-                    'methods': []
-                }
-            
-                for signature, body in methods_dict.items():
-                    filewise_method_data[file_path]['methods'].append({
-                        'signature': signature,
-                        'body': body
-                    })
-                    file_data = file_data + '\n' + body
-                # print("entities", len(methods_dict))
-                chunks = get_chunks(file_data.strip())
-                updated_chunks = ['file: ' + file_path + '\n' + s for s in chunks]
-                documents.extend(updated_chunks)
-                list_of_metadata = [{"file": file_path} for _ in updated_chunks]
-                metadatas.extend(list_of_metadata)
-        elif modified_file.change_type.name == "DELETE":
-            file_path = modified_file.old_path
-            file_path = file_path.replace("\\", "/")
-            delete_from_file_collection(file_collection, file_path)
+            file_entry, file_documents, file_metadatas = chunked_files[file_path]
+            if file_entry is not None:
+                filewise_method_data[file_path] = file_entry
+                filewise_chunk_ids[file_path] = get_chunk_ids(file_path, file_documents)
+                documents.extend(file_documents)
+                metadatas.extend(file_metadatas)
+        elif file_change.change_type == "DELETE":
+            file_path = file_change.old_path
+            vanished_ids.extend(filewise_chunk_ids.pop(file_path, []))
             delete_file_entry(file_path)
             # print("Deleted file:", file_path)
-        elif modified_file.change_type.name == "MODIFY":
-            file_path = modified_file.new_path
-            file_path = file_path.replace("\\", "/")
-            
-            delete_from_file_collection(file_collection, file_path)
+        elif file_change.change_type == "MODIFY":
+            file_path = file_change.new_path
             delete_file_entry(file_path)
             # print("Updated file:", file_path)
-            
-            file_content = modified_file.source_code
-            package, methods_dict = extract_package_and_methods(file_content)
-            if len(methods_dict)>0 and (package is not None):
-                file_data = ''
-                filewise_method_data[file_path] = {
-                    'package': package,
-                    'methods': []
-                }
-            
-                for signature, body in methods_dict.items():
-                    filewise_method_data[file_path]['methods'].append({
-                        'signature': signature,
-                        'body': body
-                    })
-                    file_data = file_data + '\n' + body
-                # print("entities", len(methods_dict))
-                chunks = get_chunks(file_data.strip())
-                updated_chunks = ['file: ' + file_path + '\n' + s for s in chunks]
-                documents.extend(updated_chunks)
-                list_of_metadata = [{"file": file_path} for _ in updated_chunks]
-                metadatas.extend(list_of_metadata)
-        elif modified_file.change_type.name == "RENAME":
-            if modified_file.source_code == None:
-                file_path = modified_file.old_path
-                old_file_path = file_path.replace("\\", "/")
-
-                # print("Renamed Old Java file:", old_file_path)
-                file_path = modified_file.new_path
-                new_file_path = file_path.replace("\\", "/")
-                # print("Renamed New Java file:", new_file_path)
-                
-                rename_file_entry(old_file_path, new_file_path)
 
-                old_chunks, old_metadata = get_chunks_and_metadata_of_a_file(file_collection, old_file_path)
-                updated_chunks = [chunk.replace(old_file_path, new_file_path) for chunk in old_chunks]
+            file_entry, file_documents, file_metadatas = chunked_files[file_path]
+            if file_entry is not None:
+                filewise_method_data[file_path] = file_entry
 
-                # print("old info",old_chunks, old_metadata)
-                documents.extend(updated_chunks)
-                list_of_metadata = [{"file": new_file_path} for _ in updated_chunks]
-                metadatas.extend(list_of_metadata)
+            # chunks whose id survives the edit keep their stored embedding
+            stored_ids = set(filewise_chunk_ids.pop(file_path, []))
+            new_ids = [calculate_hash(file_path + document) for document in file_documents]
+            if new_ids:
+                filewise_chunk_ids[file_path] = list(dict.fromkeys(new_ids))
+            vanished_ids.extend(stored_ids.difference(new_ids))
+            for chunk_id, document, metadata in zip(new_ids, file_documents, file_metadatas):
+                if chunk_id in stored_ids:
+                    chunk_counts['reused'] += 1
+                else:
+                    documents.append(document)
+                    metadatas.append(metadata)
+        elif file_change.change_type == "RENAME":
+            old_file_path = file_change.old_path
+            new_file_path = file_change.new_path
+            # print("Renamed Java file:", old_file_path, new_file_path)
 
-                # print(updated_chunks, list_of_metadata)
-                delete_from_file_collection(file_collection, old_file_path)
+            old_ids = filewise_chunk_ids.pop(old_file_path, [])
+            old_chunks = [renamed_chunks[chunk_id][0] for chunk_id in old_ids]
+            old_embeddings = [renamed_chunks[chunk_id][1] for chunk_id in old_ids]
+            if file_change.old_blob_id == file_change.new_blob_id:
+                rename_file_entry(old_file_path, new_file_path)
+                updated_chunks = [chunk.replace(old_file_path, new_file_path) for chunk in old_chunks]
+                moved_embeddings = old_embeddings
             else:
-                file_path = modified_file.old_path
-                old_file_path = file_path.replace("\\", "/")
-                # print("Renamed Old Java file:", old_file_path)
-                delete_from_file_collection(file_collection, old_file_path)
-                delete_file_entry(file_path)
-
-                file_path = modified_file.new_path
-                new_file_path = file_path.replace("\\", "/")
-
-                # print("Renamed New Java file:", new_file_path)
-                file_content = modified_file.source_code
-                package, methods_dict = extract_package_and_methods(file_content)
-                if len(methods_dict)>0 and (package is not None):
-                    file_data = ''
-                    filewise_method_data[new_file_path] = {
-                        'package': package,
-                        'methods': []
-                    }
-                
-                    for signature, body in methods_dict.items():
-                        filewise_method_data[new_file_path]['methods'].append({
-                            'signature': signature,
-                            'body': body
-                        })
-                        file_data = file_data + '\n' + body
-                    # print("entities", len(methods_dict))
-                    chunks = get_chunks(file_data.strip())
-                    updated_chunks = ['file: ' + new_file_path + '\n' + s for s in chunks]
-                    documents.extend(updated_chunks)
-                    list_of_metadata = [{"file": new_file_path} for _ in updated_chunks]
-                    metadatas.extend(list_of_metadata)
+                delete_file_entry(old_file_path)
+                file_entry, file_documents, file_metadatas = chunked_files[new_file_path]
+                if file_entry is not None:
+                    filewise_method_data[new_file_path] = file_entry
+
+                # a chunk whose code survived the move keeps its vector; only its header changes
+                old_header = get_chunk_header(old_file_path)
+                new_header = get_chunk_header(new_file_path)
+                old_embeddings_by_code = {chunk[len(old_header):]: embedding for chunk, embedding in zip(old_chunks, old_embeddings)}
+                updated_chunks = []
+                moved_embeddings = []
+                for document, metadata in zip(file_documents, file_metadatas):
+                    code = document[len(new_header):]
+                    if code in old_embeddings_by_code:
+                        updated_chunks.append(document)
+                        moved_embeddings.append(old_embeddings_by_code[code])
+                    else:
+                        documents.append(document)
+                        metadatas.append(metadata)
+                if file_documents:
+                    filewise_chunk_ids[new_file_path] = get_chunk_ids(new_file_path, file_documents)
 
+            moved_ids = [calculate_hash(new_file_path + chunk) for chunk in updated_chunks]
+            if file_change.old_blob_id == file_change.new_blob_id and moved_ids:
+                filewise_chunk_ids[new_file_path] = list(dict.fromkeys(moved_ids))
+            moved_chunks['ids'].extend(moved_ids)
+            moved_chunks['documents'].extend(updated_chunks)
+            moved_chunks['metadatas'].extend({"file": new_file_path} for _ in updated_chunks)
+            moved_chunks['embeddings'].extend(moved_embeddings)
+            chunk_counts['reused'] += len(updated_chunks)
+            vanished_ids.extend(old_ids)
+
+    # all deletions go out in one id-based call, before anything is re-added
+    delete_chunks_by_id(file_collection, vanished_ids)
+    chunk_counts['deleted'] = len(vanished_ids)
+    insert_precomputed_chunks(file_collection, moved_chunks['ids'], moved_chunks['documents'],
+                              moved_chunks['metadatas'], moved_chunks['embeddings'])
     insert_into_file_collection(file_collection, documents,metadatas)
+    chunk_counts['embedded'] = len(documents)
+    print('chunks', chunk_counts)
+    return chunk_counts
 
 
 def store_file_data(bug_id):
     try:
-        global filewise_method_data    
-        file_paths = filewise_method_data.keys()
-        all_file_data = []
-        for file_path in file_paths:
-            file_data = {
-                    "filepath" : file_path,
-                    "package": filewise_method_data[file_path]['package'],
-                    "filename": get_filename_from_path(file_path),
-                    "methods": filewise_method_data[file_path]['methods']
-                }
-            all_file_data.append(file_data)
-        
-        filename = f"{Config().get_project()}_bug_data/{bug_id}_filewise_method_data.json"
-        print(filename)
-        output_dir = os.path.dirname(filename)
-    
-        if output_dir and not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        with open(filename, 'w') as json_file:
-            json.dump(all_file_data, json_file, indent=4)
+        global filewise_method_data
+        new_records = get_snapshot_store(Config().get_project()).save_snapshot(bug_id, filewise_method_data)
+        print('snapshot', bug_id, 'new file records', new_records)
     except Exception as e:
         print(f"Error processing bug_id {bug_id}: {e}")
 
+def load_file_data(bug_id):
+    global filewise_method_data
+    filewise_method_data = get_snapshot_store(Config().get_project()).load_file_data(bug_id)
+    if filewise_method_data is None:
+        raise KeyError(f"No snapshot stored for bug {bug_id}")
+
+def resume_file_processing(bugs):
+    """Reopen the persistent index left by an earlier run; returns (prev_commit, number of bugs already done)"""
+    index_state = load_index_state()
+    if index_state is not None and not index_state['complete']:
+        # the run died while updating the live index, so only a snapshot can be trusted
+        print('index was left mid-update at', index_state['commit'])
+        index_state = None
+        snapshots = list_snapshots()
+        for bug in reversed(bugs):
+            commit = f"{bug['fixing_commit']}~1"
+            if commit in snapshots:
+                print('restoring snapshot', commit)
+                index_state = load_snapshot(commit)
+                break
+
+    bug_ids = [bug['bug_id'] for bug in bugs]
+    if index_state is None or index_state['bug_id'] not in bug_ids:
+        return "", 0
+
+    try:
+        global filewise_chunk_ids
+        filewise_chunk_ids = get_chunk_ids_by_file(open_file_collection())
+        load_file_data(index_state['bug_id'])
+    except Exception as e:
+        print(f"Could not resume from {index_state['commit']}: {e}")
+        return "", 0
+    print('resuming after bug', index_state['bug_id'], 'at', index_state['commit'])
+    return index_state['commit'], bug_ids.index(index_state['bug_id']) + 1
+
 def file_exists(file_path):
     if file_path in filewise_method_data:
         return True
@@ -0,0 +1,157 @@
+import os
+import threading
+import subprocess
+from collections import namedtuple, defaultdict, deque
+from itertools import islice
+
+FileChange = namedtuple('FileChange', ['change_type', 'old_path', 'new_path', 'old_blob_id', 'new_blob_id'])
+
+thread_local_readers = threading.local()
+# requests written ahead of the reads; small enough that they always fit in git's stdin pipe,
+# so writing never blocks on git waiting for its output to be read
+READ_AHEAD = 256
+
+
+def list_java_blobs(repo_path, commit):
+    """Map every .java path in the commit's tree to its blob id"""
+    output = subprocess.run(['git', 'ls-tree', '-r', '-z', commit], cwd=repo_path,
+                            capture_output=True, check=True).stdout
+    java_blobs = {}
+    for entry in output.split(b'\0'):
+        if not entry:
+            continue
+        info, path = entry.split(b'\t', 1)
+        mode, object_type, object_id = info.split()
+        path = path.decode('utf-8', errors='surrogateescape')
+        # 120000 entries are symlinks whose blob holds the link target, not source
+        if object_type == b'blob' and mode != b'120000' and path.endswith('.java'):
+            java_blobs[path] = object_id.decode('ascii')
+    return java_blobs
+
+
+class BlobReader:
+    """Long-lived `git cat-file --batch` process for streaming blob contents"""
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self._lock = threading.Lock()
+        self._start_process()
+
+    def _start_process(self):
+        self._process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.repo_path,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _read_object(self, blob_id):
+        header = self._process.stdout.readline().split()
+        if not header or header[-1] == b'missing':
+            raise KeyError(f"Blob not found: {blob_id}")
+        size = int(header[2])
+        content = self._process.stdout.read(size + 1)[:size]
+        return content.decode('utf-8', errors='ignore')
+
+    def read(self, blob_id):
+        with self._lock:
+            self._process.stdin.write(blob_id.encode('ascii') + b'\n')
+            self._process.stdin.flush()
+            return self._read_object(blob_id)
+
+    def read_many(self, blob_ids):
+        """Yield (blob_id, content) pairs, keeping a bounded window of requests ahead of git"""
+        blob_ids = iter(blob_ids)
+        pending = deque()
+        with self._lock:
+            try:
+                while True:
+                    if len(pending) <= READ_AHEAD // 2:
+                        requested = list(islice(blob_ids, READ_AHEAD - len(pending)))
+                        self._write_requests(requested)
+                        pending.extend(requested)
+                    if not pending:
+                        return
+                    blob_id = pending.popleft()
+                    yield blob_id, self._read_object(blob_id)
+            finally:
+                # an abandoned read leaves answers in the pipe that the next read would take for its own
+                self._discard_responses(pending)
+
+    def _write_requests(self, blob_ids):
+        if blob_ids:
+            self._process.stdin.write(b''.join(blob_id.encode('ascii') + b'\n' for blob_id in blob_ids))
+            self._process.stdin.flush()
+
+    def _discard_responses(self, blob_ids):
+        try:
+            for blob_id in blob_ids:
+                try:
+                    self._read_object(blob_id)
+                except KeyError:
+                    pass
+        except (OSError, ValueError):
+            # the pipe is broken, so start over with a new process
+            self._process.kill()
+            self._process.wait()
+            self._start_process()
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+
+def get_blob_reader(repo_path):
+    """One reader per thread and repository, so concurrent commits never share a pipe"""
+    readers = getattr(thread_local_readers, 'readers', None)
+    if readers is None:
+        readers = thread_local_readers.readers = {}
+    repo_path = str(repo_path)
+    if repo_path not in readers:
+        readers[repo_path] = BlobReader(repo_path)
+    return readers[repo_path]
+
+
+def read_blobs(repo_path, blob_ids):
+    """Read the given blobs through the thread's long-lived `git cat-file --batch` process"""
+    unique_blob_ids = list(dict.fromkeys(blob_ids))
+    return dict(get_blob_reader(repo_path).read_many(unique_blob_ids))
+
+
+def diff_trees(old_tree, new_tree):
+    """Exact add/delete/modify/rename set between two path -> blob id maps.
+
+    A deleted path whose blob reappears at an added path is a pure RENAME. A
+    deleted and an added file that are the only ones sharing a basename are an
+    edited move, reported as a RENAME with a new blob; anything else comes out
+    as a DELETE plus an ADD.
+    """
+    deleted = {path: blob_id for path, blob_id in old_tree.items() if path not in new_tree}
+    added = {path: blob_id for path, blob_id in new_tree.items() if path not in old_tree}
+
+    added_paths_by_blob = defaultdict(list)
+    for path in sorted(added):
+        added_paths_by_blob[added[path]].append(path)
+
+    renames = []
+    for old_path in sorted(deleted):
+        candidates = added_paths_by_blob.get(deleted[old_path])
+        if candidates:
+            new_path = candidates.pop(0)
+            renames.append(FileChange('RENAME', old_path, new_path, deleted[old_path], added.pop(new_path)))
+    for rename in renames:
+        del deleted[rename.old_path]
+
+    deleted_paths_by_name = defaultdict(list)
+    for path in sorted(deleted):
+        deleted_paths_by_name[os.path.basename(path)].append(path)
+    added_paths_by_name = defaultdict(list)
+    for path in sorted(added):
+        added_paths_by_name[os.path.basename(path)].append(path)
+    for filename, old_paths in deleted_paths_by_name.items():
+        new_paths = added_paths_by_name.get(filename, [])
+        if len(old_paths) == 1 and len(new_paths) == 1:
+            old_path, new_path = old_paths[0], new_paths[0]
+            renames.append(FileChange('RENAME', old_path, new_path, deleted.pop(old_path), added.pop(new_path)))
+
+    file_changes = [FileChange('DELETE', path, None, deleted[path], None) for path in sorted(deleted)]
+    file_changes.extend(FileChange('ADD', None, path, None, added[path]) for path in sorted(added))
+    file_changes.extend(FileChange('MODIFY', path, path, old_tree[path], new_tree[path]) for path in sorted(new_tree)
+                        if path in old_tree and old_tree[path] != new_tree[path])
+    file_changes.extend(renames)
+    return file_changes
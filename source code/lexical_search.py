@@ -0,0 +1,212 @@
+import threading
+from collections import Counter
+import numpy as np
+from db_handler import add_collection_listener
+from code_search import get_identifier_terms
+
+# BM25 saturation and length normalization, the usual defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+# chunks fetched from the collection per request while rebuilding
+REBUILD_BATCH_SIZE = 5000
+
+lexical_search_index = None
+
+
+class LexicalSearchIndex:
+    """BM25 over the identifiers of every chunk of the collection, pooled into file scores.
+
+    Chunks are tokenized into whole identifiers and their camelCase/snake_case parts, so a
+    bug report naming a class, method or stack frame matches the code spelling it. Postings
+    are appended as chunks arrive and deleted chunks are only marked dead until they
+    outnumber the live ones. After a reset it rebuilds from the collection on the next search.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._clear()
+            self._stale = True
+
+    def _clear(self):
+        self._num_rows = 0
+        self._num_dead = 0
+        self._total_length = 0
+        self._row_ids = []
+        self._row_files = np.zeros(0, dtype=np.int32)
+        self._row_lengths = np.zeros(0, dtype=np.float32)
+        self._live = np.zeros(0, dtype=bool)
+        self._rows = {}
+        self._files = []
+        self._file_indexes = {}
+        # term -> ([rows], [term frequencies]), with numpy copies made on first use
+        self._postings = {}
+        self._posting_arrays = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add_chunks(self, ids, documents, metadatas, embeddings):
+        with self._lock:
+            if not self._stale:
+                self._add_rows(ids, documents, [metadata['file'] for metadata in metadatas])
+
+    def _add_rows(self, ids, documents, files):
+        # chunk ids hash the file and the text, so a known id already has the right postings
+        new_positions = {}
+        for i, chunk_id in enumerate(ids):
+            if chunk_id not in self._rows and chunk_id not in new_positions:
+                new_positions[chunk_id] = i
+        if not new_positions:
+            return
+        self._reserve(self._num_rows + len(new_positions))
+
+        for row, (chunk_id, i) in enumerate(new_positions.items(), start=self._num_rows):
+            file_index = self._file_indexes.get(files[i])
+            if file_index is None:
+                file_index = self._file_indexes[files[i]] = len(self._files)
+                self._files.append(files[i])
+            term_counts = Counter(get_identifier_terms(documents[i]))
+            for term, count in term_counts.items():
+                posting = self._postings.get(term)
+                if posting is None:
+                    posting = self._postings[term] = ([], [])
+                posting[0].append(row)
+                posting[1].append(count)
+                self._posting_arrays.pop(term, None)
+            length = sum(term_counts.values())
+            self._row_files[row] = file_index
+            self._row_lengths[row] = length
+            self._live[row] = True
+            self._total_length += length
+            self._rows[chunk_id] = row
+            self._row_ids.append(chunk_id)
+        self._num_rows += len(new_positions)
+
+    def _reserve(self, num_rows):
+        capacity = len(self._live)
+        if num_rows <= capacity:
+            return
+        capacity = max(num_rows, capacity * 2, 1024)
+        row_files = np.zeros(capacity, dtype=np.int32)
+        row_lengths = np.zeros(capacity, dtype=np.float32)
+        live = np.zeros(capacity, dtype=bool)
+        row_files[:self._num_rows] = self._row_files[:self._num_rows]
+        row_lengths[:self._num_rows] = self._row_lengths[:self._num_rows]
+        live[:self._num_rows] = self._live[:self._num_rows]
+        self._row_files, self._row_lengths, self._live = row_files, row_lengths, live
+
+    def delete_chunks(self, ids):
+        with self._lock:
+            if self._stale:
+                return
+            for chunk_id in ids:
+                row = self._rows.pop(chunk_id, None)
+                if row is not None:
+                    self._live[row] = False
+                    self._total_length -= self._row_lengths[row]
+                    self._num_dead += 1
+            if self._num_dead > max(len(self._rows), 1024):
+                self._compact()
+
+    def delete_file(self, file_path):
+        file_index = self._file_indexes.get(file_path)
+        if file_index is not None:
+            rows = np.flatnonzero(self._live[:self._num_rows] & (self._row_files[:self._num_rows] == file_index))
+            self.delete_chunks([self._row_ids[row] for row in rows])
+
+    def _compact(self):
+        # postings hold no text, so the surviving rows are renumbered in place
+        live_rows = np.flatnonzero(self._live[:self._num_rows])
+        new_rows = np.full(self._num_rows, -1, dtype=np.int64)
+        new_rows[live_rows] = np.arange(len(live_rows))
+        postings = {}
+        for term, (rows, counts) in self._postings.items():
+            rows = np.asarray(rows)
+            kept = new_rows[rows] >= 0
+            if kept.any():
+                postings[term] = (new_rows[rows[kept]].tolist(), np.asarray(counts)[kept].tolist())
+        row_ids = [self._row_ids[row] for row in live_rows]
+        self._row_files[:len(live_rows)] = self._row_files[live_rows]
+        self._row_lengths[:len(live_rows)] = self._row_lengths[live_rows]
+        self._live[:] = False
+        self._live[:len(live_rows)] = True
+        self._num_rows = len(live_rows)
+        self._num_dead = 0
+        self._row_ids = row_ids
+        self._rows = {chunk_id: row for row, chunk_id in enumerate(row_ids)}
+        self._postings = postings
+        self._posting_arrays = {}
+
+    def refresh(self, file_collection):
+        """Rebuild the index if a reset has left it stale"""
+        with self._lock:
+            if self._stale:
+                self._rebuild(file_collection)
+
+    def rebuild(self, file_collection):
+        """Reload and tokenize every chunk of the collection"""
+        with self._lock:
+            self._rebuild(file_collection)
+
+    def _rebuild(self, file_collection):
+        # pages go by id, since offsets shift whenever chunks are deleted in between
+        ids = file_collection.get(include=[])["ids"]
+        self._clear()
+        for i in range(0, len(ids), REBUILD_BATCH_SIZE):
+            data = file_collection.get(ids=ids[i:i + REBUILD_BATCH_SIZE], include=["documents", "metadatas"])
+            self._add_rows(data["ids"], data["documents"], [metadata["file"] for metadata in data["metadatas"]])
+        self._stale = False
+
+    def _get_posting_arrays(self, term):
+        arrays = self._posting_arrays.get(term)
+        if arrays is None:
+            rows, counts = self._postings[term]
+            arrays = self._posting_arrays[term] = (np.asarray(rows, dtype=np.int64), np.asarray(counts, dtype=np.float32))
+        return arrays
+
+    def search(self, query_text, n_files, file_collection):
+        """The n_files best files as (file path, score, id of the file's best chunk), best first"""
+        self.refresh(file_collection)
+        query_terms = set(get_identifier_terms(query_text))
+        with self._lock:
+            num_live = len(self._rows)
+            if num_live == 0:
+                return []
+            average_length = self._total_length / num_live
+            live = self._live[:self._num_rows]
+            length_norms = BM25_K1 * (1 - BM25_B + BM25_B * self._row_lengths[:self._num_rows] / average_length)
+            scores = np.zeros(self._num_rows, dtype=np.float32)
+            for term in query_terms:
+                if term not in self._postings:
+                    continue
+                rows, counts = self._get_posting_arrays(term)
+                document_frequency = int(live[rows].sum())
+                if document_frequency == 0:
+                    continue
+                idf = np.log(1 + (num_live - document_frequency + 0.5) / (document_frequency + 0.5))
+                scores[rows] += idf * counts * (BM25_K1 + 1) / (counts + length_norms[rows])
+
+            # a file scores as its best chunk
+            matched_rows = np.flatnonzero((scores > 0) & live)
+            if len(matched_rows) == 0:
+                return []
+            matched_rows = matched_rows[np.lexsort((matched_rows, -scores[matched_rows]))]
+            _, first = np.unique(self._row_files[matched_rows], return_index=True)
+            best_rows = matched_rows[np.sort(first)][:n_files]
+            return [(self._files[self._row_files[row]], float(scores[row]), self._row_ids[row]) for row in best_rows]
+
+
+def initialize_lexical_search_index():
+    global lexical_search_index
+    if lexical_search_index is None:
+        lexical_search_index = LexicalSearchIndex()
+        add_collection_listener(lexical_search_index)
+    return lexical_search_index
+
+
+def get_lexical_search_index():
+    global lexical_search_index
+    return lexical_search_index
@@ -2,9 +2,15 @@ from bug_data_retriever import get_bug_data
 from pydriller import Git
 from config import Config
 from file_processor import *
-from db_handler import initialize_db
+from db_handler import initialize_db, save_index_state, save_snapshot, get_embedding_function
 from file_parser import initialize_parser
+from parse_cache import initialize_parse_cache, get_parse_cache
+from embedding_cache import get_embedding_cache
+from embedding_handler import shutdown_encode_pool
+from snapshot_store import get_snapshot_store, close_snapshot_stores
 from collection_handler import get_suspicious_files
+from exact_search import initialize_exact_search_index
+from lexical_search import initialize_lexical_search_index
 from datetime import datetime
 import sys
 
@@ -17,24 +23,68 @@ def main():
     config = Config()
     config.set_project(project)
     config.set_embedding_type(embedding_type)
+    if len(sys.argv) > 5:
+        config.set_num_workers(int(sys.argv[5]))
+    if len(sys.argv) > 6:
+        config.set_db_path(sys.argv[6])
+    if len(sys.argv) > 7:
+        config.set_snapshot_interval(int(sys.argv[7]))
+    if len(sys.argv) > 8:
+        config.set_embedding_concurrency(int(sys.argv[8]))
+    if len(sys.argv) > 9:
+        config.set_embedding_batch_size(int(sys.argv[9]))
+    if len(sys.argv) > 10:
+        config.set_embedding_threads(int(sys.argv[10]))
+    if len(sys.argv) > 11:
+        config.set_embedding_processes(int(sys.argv[11]))
+    if len(sys.argv) > 12:
+        config.set_retrieval_backend(sys.argv[12])
+    if len(sys.argv) > 13:
+        config.set_file_pooling(sys.argv[13])
+    if len(sys.argv) > 14:
+        config.set_hybrid_latency_budget(float(sys.argv[14]))
     new_bugs = get_bug_data(xml_path)
 
     git_repo = Git(repo_path)
     prev_commit = ""
 
     initialize_parser()
-    initialize_db()
+    initialize_db(config.get_db_path())
+    if config.get_retrieval_backend() == 'exact':
+        initialize_exact_search_index()
+    elif config.get_retrieval_backend() == 'hybrid':
+        initialize_lexical_search_index()
+    initialize_parse_cache(f"{project}_bug_data/parse_cache.sqlite")
 
-    for bug in new_bugs:
+    processed_bugs = 0
+    if config.get_db_path():
+        prev_commit, processed_bugs = resume_file_processing(new_bugs)
+
+    for bug_number, bug in enumerate(new_bugs[processed_bugs:], start=processed_bugs + 1):
         print('bug-id:', bug['bug_id'], 'commits', prev_commit, f"{bug['fixing_commit']}~1")
+        save_index_state(bug['bug_id'], f"{bug['fixing_commit']}~1", complete=False)
         manage_file_processing(git_repo, bug['bug_id'], prev_commit, f"{bug['fixing_commit']}~1")
         # starting_time = datetime.now()
         get_suspicious_files(bug['bug_id'], str(bug['summary'] or '')+ ' ' + str(bug['description'] or ''))
         # ending_time = datetime.now()
         # print('searching time:', ending_time-starting_time)
+        save_index_state(bug['bug_id'], f"{bug['fixing_commit']}~1", complete=True)
+        if config.get_snapshot_interval() > 0 and bug_number % config.get_snapshot_interval() == 0:
+            save_snapshot(f"{bug['fixing_commit']}~1", bug['bug_id'])
 
         prev_commit = f"{bug['fixing_commit']}~1"
     
+    shutdown_worker_pool()
+    shutdown_encode_pool()
+    print('parse cache', get_parse_cache().get_stats())
+    get_parse_cache().close()
+    if get_embedding_cache() is not None:
+        print('embedding cache', get_embedding_cache().get_stats())
+        get_embedding_cache().close()
+    if hasattr(get_embedding_function(), 'get_stats'):
+        print('embedding client', get_embedding_function().get_stats())
+    print('snapshot store', get_snapshot_store(project).get_stats())
+    close_snapshot_stores()
     end_time = datetime.now()
 
     print('total time', end_time-start_time)
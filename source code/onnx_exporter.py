@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import shutil
+import time
+import numpy as np
+from config import Config
+from embedding_handler import AlibabaEmbedding, OnnxAlibabaEmbedding
+from embedding_benchmark import encode_with_defaults, get_documents
+from file_parser import initialize_parser
+
+# queries drawn from the chunks themselves to compare the rankings of both models
+NUM_VALIDATION_QUERIES = 50
+TOP_K = 10
+
+
+def export_model(output_dir, quantize):
+    """Export the gte SentenceTransformer, pooling included, to output_dir/model.onnx"""
+    import torch
+    AlibabaEmbedding._load_model()
+    model = AlibabaEmbedding._model.cpu().eval()
+    tokenizer = AlibabaEmbedding._tokenizer
+    example = tokenizer(['public void example() { return; }'] * 2, padding=True, return_tensors='pt')
+    input_names = [name for name in tokenizer.model_input_names if name in example]
+
+    class SentenceEmbeddingGraph(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(dict(zip(input_names, inputs)))['sentence_embedding']
+
+    os.makedirs(output_dir, exist_ok=True)
+    fp32_path = os.path.join(output_dir, 'model_fp32.onnx')
+    model_path = os.path.join(output_dir, 'model.onnx')
+    with torch.no_grad():
+        torch.onnx.export(
+            SentenceEmbeddingGraph(),
+            tuple(example[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=['sentence_embedding'],
+            dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names},
+                          'sentence_embedding': {0: 'batch'}},
+            opset_version=17,
+            dynamo=False
+        )
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+        # shape inference and graph optimization first, so more of the graph gets quantized
+        preprocessed_path = os.path.join(output_dir, 'model_preprocessed.onnx')
+        quant_pre_process(fp32_path, preprocessed_path, skip_symbolic_shape=True)
+        quantize_dynamic(preprocessed_path, model_path, weight_type=QuantType.QInt8)
+        os.remove(preprocessed_path)
+    else:
+        shutil.copyfile(fp32_path, model_path)
+    tokenizer.save_pretrained(output_dir)
+
+    export_info = {
+        'model_name': f"{AlibabaEmbedding.model_name}-onnx-{'int8' if quantize else 'fp32'}",
+        'source_model': AlibabaEmbedding.model_name,
+        'quantized': quantize,
+        'input_names': input_names,
+        'max_seq_length': model.max_seq_length
+    }
+    with open(os.path.join(output_dir, 'export_info.json'), 'w') as file:
+        json.dump(export_info, file, indent=4)
+    return export_info
+
+
+def get_top_k(queries, documents):
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    documents = documents / np.linalg.norm(documents, axis=1, keepdims=True)
+    return np.argsort(-(queries @ documents.T), axis=1)[:, :TOP_K]
+
+
+def validate_model(output_dir, documents):
+    """Compare the exported model with the PyTorch one on cosine agreement, rankings and speed"""
+    OnnxAlibabaEmbedding.model_dir = output_dir
+    onnx_embedding = OnnxAlibabaEmbedding(num_processes=1)
+    pytorch_embedding = AlibabaEmbedding(num_processes=1)
+    # warm both up before timing
+    encode_with_defaults(documents[:8])
+    onnx_embedding.embed(documents[:8])
+
+    starting_time = time.perf_counter()
+    pytorch_embeddings = np.asarray(encode_with_defaults(documents), dtype=np.float32)
+    pytorch_seconds = time.perf_counter() - starting_time
+    starting_time = time.perf_counter()
+    pytorch_embedding.embed(documents)
+    throughput_seconds = time.perf_counter() - starting_time
+    starting_time = time.perf_counter()
+    onnx_embeddings = onnx_embedding.embed(documents)
+    onnx_seconds = time.perf_counter() - starting_time
+
+    cosines = np.sum(pytorch_embeddings * onnx_embeddings, axis=1) / (
+        np.linalg.norm(pytorch_embeddings, axis=1) * np.linalg.norm(onnx_embeddings, axis=1))
+    query_indexes = np.linspace(0, len(documents) - 1, min(NUM_VALIDATION_QUERIES, len(documents))).astype(int)
+    pytorch_top_k = get_top_k(pytorch_embeddings[query_indexes], pytorch_embeddings)
+    onnx_top_k = get_top_k(onnx_embeddings[query_indexes], onnx_embeddings)
+    overlaps = [len(set(pytorch_row) & set(onnx_row)) / TOP_K for pytorch_row, onnx_row in zip(pytorch_top_k, onnx_top_k)]
+
+    return {
+        'chunks': len(documents),
+        'min_cosine': round(float(cosines.min()), 6),
+        'mean_cosine': round(float(cosines.mean()), 6),
+        f'mean_top_{TOP_K}_overlap': round(float(np.mean(overlaps)), 4),
+        'top_1_agreement': round(float(np.mean(pytorch_top_k[:, 0] == onnx_top_k[:, 0])), 4),
+        'pytorch_chunks_per_second': round(len(documents) / pytorch_seconds, 1),
+        'pytorch_throughput_mode_chunks_per_second': round(len(documents) / throughput_seconds, 1),
+        'onnx_chunks_per_second': round(len(documents) / onnx_seconds, 1),
+        'speed_up': round(pytorch_seconds / onnx_seconds, 2),
+        'speed_up_over_throughput_mode': round(throughput_seconds / onnx_seconds, 2),
+        'model_mb': round(os.path.getsize(os.path.join(output_dir, 'model.onnx')) / (1024 * 1024), 1),
+        'fp32_model_mb': round(os.path.getsize(os.path.join(output_dir, 'model_fp32.onnx')) / (1024 * 1024), 1)
+    }
+
+
+def main():
+    repo_path = sys.argv[1]
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else OnnxAlibabaEmbedding.model_dir
+    precision = sys.argv[3] if len(sys.argv) > 3 else 'int8'
+    num_chunks = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+    if precision not in ('int8', 'fp32'):
+        raise ValueError("Precision must be one of ['int8', 'fp32']")
+    config = Config()
+    config.set_project('onnx_export')
+    config.set_embedding_type('gte')
+
+    export_info = export_model(output_dir, precision == 'int8')
+    print('exported', export_info['model_name'], 'to', output_dir)
+
+    initialize_parser()
+    report = validate_model(output_dir, get_documents(repo_path, num_chunks))
+    with open(os.path.join(output_dir, 'validation.json'), 'w') as file:
+        json.dump(report, file, indent=4)
+    for key, value in report.items():
+        print(key, value)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import os
+import json
+import zlib
+import sqlite3
+import threading
+
+# Bump whenever file_parser changes what extract_package_and_methods returns
+PARSER_VERSION = 3
+DEFAULT_MAX_SIZE_MB = 2048
+
+parse_cache = None
+
+
+class ParseCache:
+    """On-disk cache of parsed Java files keyed by git blob hash"""
+    def __init__(self, cache_path, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._touched = set()
+
+        self._connection = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache_info (key TEXT PRIMARY KEY, value TEXT)")
+        self._invalidate_if_stale()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS parsed_files ("
+            "blob_hash TEXT PRIMARY KEY, package TEXT, methods BLOB, method_references BLOB, size INTEGER, last_used INTEGER)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS parsed_files_last_used ON parsed_files(last_used)")
+        self._connection.commit()
+
+        row = self._connection.execute("SELECT MAX(last_used), COALESCE(SUM(size), 0) FROM parsed_files").fetchone()
+        self._generation = (row[0] or 0) + 1
+        self._size = row[1]
+
+    def _invalidate_if_stale(self):
+        row = self._connection.execute("SELECT value FROM cache_info WHERE key = 'parser_version'").fetchone()
+        if row is None or int(row[0]) != PARSER_VERSION:
+            # the table is recreated, since its columns follow what the parser returns
+            self._connection.execute("DROP TABLE IF EXISTS parsed_files")
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache_info VALUES ('parser_version', ?)", (str(PARSER_VERSION),))
+            self._connection.commit()
+
+    def get(self, blob_hash):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT package, methods, method_references FROM parsed_files WHERE blob_hash = ?", (blob_hash,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched.add(blob_hash)
+        return row[0], json.loads(zlib.decompress(row[1])), json.loads(zlib.decompress(row[2]))
+
+    def put(self, blob_hash, package, methods, references):
+        data = zlib.compress(json.dumps(methods).encode('utf-8'))
+        references_data = zlib.compress(json.dumps(references).encode('utf-8'))
+        with self._lock:
+            self._pending[blob_hash] = (blob_hash, package, data, references_data,
+                                        len(data) + len(references_data), self._generation)
+            if len(self._pending) >= 1000:
+                self._write_pending()
+
+    def _write_pending(self):
+        if self._pending:
+            # a replaced entry gives back its old size
+            blob_hashes = list(self._pending)
+            for i in range(0, len(blob_hashes), 900):
+                subset_of_hashes = blob_hashes[i:i + 900]
+                placeholders = ','.join('?' * len(subset_of_hashes))
+                self._size -= self._connection.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM parsed_files WHERE blob_hash IN ({placeholders})",
+                    subset_of_hashes).fetchone()[0]
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO parsed_files VALUES (?, ?, ?, ?, ?, ?)", self._pending.values())
+            self._size += sum(entry[4] for entry in self._pending.values())
+            self._pending = {}
+        if self._touched:
+            self._connection.executemany(
+                "UPDATE parsed_files SET last_used = ? WHERE blob_hash = ?",
+                [(self._generation, blob_hash) for blob_hash in self._touched])
+            self._touched = set()
+        self._connection.commit()
+
+    def flush(self):
+        """Write pending entries and evict least recently used ones beyond the size bound"""
+        with self._lock:
+            self._write_pending()
+            if self._size > self.max_size:
+                self._evict()
+            self._generation += 1
+
+    def _evict(self):
+        # drop the oldest generations first, never the entries used by the current one
+        target_size = int(self.max_size * 0.9)
+        cursor = self._connection.execute(
+            "SELECT blob_hash, size FROM parsed_files WHERE last_used < ? ORDER BY last_used", (self._generation,))
+        evicted = []
+        for blob_hash, size in cursor:
+            if self._size <= target_size:
+                break
+            evicted.append((blob_hash,))
+            self._size -= size
+        self._connection.executemany("DELETE FROM parsed_files WHERE blob_hash = ?", evicted)
+        self._connection.commit()
+        self.evictions += len(evicted)
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0,
+                "evictions": self.evictions,
+                "size_mb": round(self._size / (1024 * 1024), 2)
+            }
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+
+def initialize_parse_cache(cache_path, max_size_mb=DEFAULT_MAX_SIZE_MB):
+    global parse_cache
+    parse_cache = ParseCache(cache_path, max_size_mb)
+
+
+def get_parse_cache():
+    global parse_cache
+    return parse_cache
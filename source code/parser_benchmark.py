@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+from file_parser import initialize_parser, parse_file, extract_package_and_methods, get_receiver, count_arguments, \
+    get_creation_reference, extract_node_text, get_method_signature
+
+CLASS_DECLARATION_TYPES = ('class_declaration', 'interface_declaration', 'enum_declaration', 'record_declaration')
+
+
+def extract_with_recursive_walk(content):
+    """The recursive Python traversal extract_package_and_methods used before the query, kept as the baseline"""
+    package = None
+    methods = {}
+    classes = []
+    method_references = {}
+    source, root_node = parse_file(content)
+    if root_node is not None:
+        for node in root_node.children:
+            if node.type == 'package_declaration':
+                for child in node.children:
+                    if child.type == 'scoped_identifier':
+                        package = child.text.decode('utf-8')
+
+        def traverse(node, enclosing_references):
+            if node.type == 'method_declaration' or node.type == 'constructor_declaration':
+                method_signature = get_method_signature(source, node)
+                methods[method_signature] = node.text.decode('utf-8')
+                method_references[method_signature] = {'calls': {}, 'fields': {}}
+                enclosing_references = enclosing_references + [method_references[method_signature]]
+            elif node.type in CLASS_DECLARATION_TYPES:
+                classes.append(extract_node_text(source, node, 'name', '<unknown>'))
+            elif enclosing_references:
+                if node.type == 'field_access':
+                    field = (extract_node_text(source, node, 'field', '<unknown>'), get_receiver(source, node))
+                    for references in enclosing_references:
+                        references['fields'].setdefault(field, None)
+                elif node.type in ('method_invocation', 'object_creation_expression'):
+                    if node.type == 'method_invocation':
+                        call = (extract_node_text(source, node, 'name', '<unknown>'), count_arguments(node),
+                                get_receiver(source, node))
+                    else:
+                        call = get_creation_reference(source, node)
+                    if call is not None:
+                        for references in enclosing_references:
+                            references['calls'].setdefault(call, None)
+            for child in node.children:
+                traverse(child, enclosing_references)
+
+        traverse(root_node, [])
+
+    references = {
+        'classes': list(dict.fromkeys(classes)),
+        'methods': {
+            signature: {
+                'calls': [list(call) for call in method_references[signature]['calls']],
+                'fields': [list(field) for field in method_references[signature]['fields']]
+            } for signature in methods
+        }
+    }
+    return package, methods, references
+
+
+def read_java_files(repo_path):
+    contents = []
+    for root, dirs, files in os.walk(repo_path):
+        for file in files:
+            if file.endswith(".java"):
+                with open(os.path.join(root, file), encoding="utf8", errors="ignore") as java_file:
+                    contents.append(java_file.read())
+    return contents
+
+
+def time_extraction(extract, contents, repetitions):
+    best = None
+    for _ in range(repetitions):
+        starting_time = time.perf_counter()
+        results = [extract(content) for content in contents]
+        elapsed = time.perf_counter() - starting_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    repo_path = sys.argv[1]
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    # deeply nested generated code needs more frames than the default for the recursive walk
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+
+    initialize_parser()
+    contents = read_java_files(repo_path)
+    size_mb = sum(len(content) for content in contents) / (1024 * 1024)
+    print('files', len(contents), 'size mb', round(size_mb, 2))
+
+    # parsing alone is the floor both extractions share
+    parse_seconds, _ = time_extraction(parse_file, contents, repetitions)
+    walk_seconds, walk_results = time_extraction(extract_with_recursive_walk, contents, repetitions)
+    query_seconds, query_results = time_extraction(extract_package_and_methods, contents, repetitions)
+
+    mismatches = sum(1 for walk_result, query_result in zip(walk_results, query_results) if walk_result != query_result)
+    print('parse only', round(parse_seconds, 3), 's')
+    print('recursive walk', round(walk_seconds, 3), 's', round(len(contents) / walk_seconds), 'files/s')
+    print('query', round(query_seconds, 3), 's', round(len(contents) / query_seconds), 'files/s')
+    print('extraction speed-up', round((walk_seconds - parse_seconds) / max(query_seconds - parse_seconds, 1e-9), 2),
+          'overall speed-up', round(walk_seconds / query_seconds, 2))
+    print('mismatched files', mismatches)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import json
 import sys
 import re
 from datetime import datetime
+from snapshot_store import get_snapshot_store
 
 def tokenize_filename(filename):
     normalized = re.sub(r'[\./]', ' ', filename) # Replace '/' and '.' with spaces, then split by whitespace
@@ -57,10 +58,11 @@ def extract_filename(full_path):
 
 def get_suspicious_files(project, bug_id, data):
     suspicious_files = []
-    json_file = project + '_bug_data/' + bug_id + '_filewise_method_data.json'
-    
-    with open(json_file, 'r') as current_file:
-        file_wise_method_data = json.load(current_file)
+    # only the paths are needed, so the manifest is read without loading any method data
+    file_paths = get_snapshot_store(project).load_manifest(bug_id)
+    if file_paths is None:
+        raise FileNotFoundError(f"No snapshot stored for bug {bug_id}")
+    file_wise_method_data = [{"filepath": file_path, "filename": os.path.basename(file_path)} for file_path in file_paths]
 
     seen_filenames = set()
     bug_report_analysis, results = parse_json(data)
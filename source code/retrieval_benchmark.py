@@ -0,0 +1,83 @@
+import sys
+import time
+import numpy as np
+from config import Config
+from bug_data_retriever import get_bug_data
+from db_handler import initialize_db, open_file_collection
+from collection_handler import bug_report_splitter, compute_embeddings, query_exact_search, SUSPICIOUS_RESULTS
+from exact_search import initialize_exact_search_index
+
+
+def get_unique_files(metadatas, top_n):
+    """Files in the order of their first chunk, the way the consumers of the query results read them"""
+    return list(dict.fromkeys(metadata['file'] for metadata in metadatas))[:top_n]
+
+
+def get_percentiles(seconds):
+    milliseconds = np.asarray(seconds) * 1000
+    return {'mean': round(float(milliseconds.mean()), 2), 'p50': round(float(np.percentile(milliseconds, 50)), 2),
+            'p95': round(float(np.percentile(milliseconds, 95)), 2)}
+
+
+def compare_backends(file_collection, bug_reports, top_n):
+    """Time HNSW and exact search on the same query embeddings and measure how many exact top files HNSW finds"""
+    query_embeddings = [compute_embeddings(bug_report_splitter.split_text(bug_report)) for bug_report in bug_reports]
+
+    starting_time = time.perf_counter()
+    initialize_exact_search_index().rebuild(file_collection)
+    build_seconds = time.perf_counter() - starting_time
+
+    hnsw_seconds = []
+    exact_seconds = []
+    recalls = []
+    for embeddings in query_embeddings:
+        starting_time = time.perf_counter()
+        hnsw_results = file_collection.query(query_embeddings=embeddings.tolist(), n_results=SUSPICIOUS_RESULTS,
+                                             include=['documents', 'metadatas', 'distances'])
+        hnsw_seconds.append(time.perf_counter() - starting_time)
+        starting_time = time.perf_counter()
+        exact_results = query_exact_search(file_collection, embeddings, SUSPICIOUS_RESULTS, 'max')
+        exact_seconds.append(time.perf_counter() - starting_time)
+
+        # max pooling ranks files exactly as deduplicating a complete chunk ranking would
+        exact_files = get_unique_files(exact_results['metadatas'][0], top_n)
+        hnsw_files = get_unique_files(hnsw_results['metadatas'][0], top_n)
+        recalls.append(len(set(exact_files) & set(hnsw_files)) / max(len(exact_files), 1))
+
+    all_embeddings = np.concatenate(query_embeddings)
+    starting_time = time.perf_counter()
+    query_exact_search(file_collection, all_embeddings, SUSPICIOUS_RESULTS, 'max')
+    batched_seconds = time.perf_counter() - starting_time
+
+    return {
+        'chunks': file_collection.count(),
+        'bug_reports': len(bug_reports),
+        'queries': len(all_embeddings),
+        'exact_build_seconds': round(build_seconds, 2),
+        'hnsw_ms': get_percentiles(hnsw_seconds),
+        'exact_ms': get_percentiles(exact_seconds),
+        'exact_batched_ms_per_query': round(batched_seconds * 1000 / len(all_embeddings), 2),
+        f'hnsw_file_recall_at_{top_n}': round(float(np.mean(recalls)), 4)
+    }
+
+
+def main():
+    project = sys.argv[1]
+    db_path = sys.argv[2]
+    xml_path = sys.argv[3]
+    embedding_type = sys.argv[4]
+    top_n = int(sys.argv[5]) if len(sys.argv) > 5 else 50
+    config = Config()
+    config.set_project(project)
+    config.set_embedding_type(embedding_type)
+    config.set_db_path(db_path)
+
+    initialize_db(db_path)
+    file_collection = open_file_collection()
+    bug_reports = [str(bug['summary'] or '') + ' ' + str(bug['description'] or '') for bug in get_bug_data(xml_path)]
+    for key, value in compare_backends(file_collection, bug_reports, top_n).items():
+        print(key, value)
+
+
+if __name__ == "__main__":
+    main()
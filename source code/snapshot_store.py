@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import mmap
+import zlib
+import sqlite3
+import hashlib
+import threading
+from code_search import CodeSearchIndex
+from call_graph import CallGraphIndex
+
+# Bump whenever the layout of the store changes; an older store is cleared and rebuilt
+STORE_VERSION = 4
+# a manifest is written in full once its chain of deltas reaches this length
+MAX_DELTA_CHAIN = 32
+
+snapshot_stores = {}
+snapshot_registries = {}
+snapshot_stores_lock = threading.Lock()
+
+
+def compress_json(data):
+    return zlib.compress(json.dumps(data).encode('utf-8'))
+
+
+def decompress_json(data):
+    return json.loads(zlib.decompress(data))
+
+
+def calculate_record_hash(file_entry):
+    content = json.dumps([file_entry['package'], file_entry['methods'], file_entry['references']]).encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class SnapshotView:
+    """Read-only view of one bug's snapshot.
+
+    File paths, packages and method signatures are loaded when the view is opened;
+    method bodies stay on disk and are sliced out of the store's memory map on request.
+    """
+    def __init__(self, snapshot_store, bug_id, manifest, records):
+        self.snapshot_store = snapshot_store
+        self.bug_id = bug_id
+        self.manifest = manifest
+        self.paths = list(manifest)
+        self._records = {file_path: records[record_hash] for file_path, record_hash in manifest.items()}
+        self._indexes = {}
+        self._indexes_lock = threading.RLock()
+
+    def __contains__(self, file_path):
+        return file_path in self._records
+
+    def get_package(self, file_path):
+        return self._records[file_path][0]
+
+    def get_signatures(self, file_path):
+        return self._records[file_path][1]
+
+    def get_method_body(self, file_path, method_index):
+        offset, length = self._records[file_path][2][method_index]
+        return self.snapshot_store.read_body(offset, length)
+
+    def get_index(self, name, build_index):
+        """Build a derived index once per view, however many processors share it"""
+        with self._indexes_lock:
+            if name not in self._indexes:
+                self._indexes[name] = build_index(self)
+            return self._indexes[name]
+
+
+class SnapshotStore:
+    """Content-addressed store of the per-bug method data.
+
+    Each distinct file record (package and method signatures) is stored once under the
+    hash of its content, and each distinct method body once in an append-only file that
+    readers memory-map. A bug's snapshot is a manifest of file path -> record hash,
+    written as a delta against the manifest saved before it.
+    """
+    def __init__(self, store_path):
+        store_dir = os.path.dirname(store_path)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self._lock = threading.Lock()
+        self._bodies_path = os.path.splitext(store_path)[0] + '_bodies.bin'
+        self._bodies_map = None
+        self._connection = sqlite3.connect(store_path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT)")
+        self._invalidate_if_stale()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS file_records (record_hash TEXT PRIMARY KEY, package TEXT, methods BLOB)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS method_bodies (body_hash TEXT PRIMARY KEY, offset INTEGER, length INTEGER)")
+        # manifests are immutable; rewriting a bug only repoints it, so delta chains never change underneath
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS manifests ("
+            "manifest_id INTEGER PRIMARY KEY AUTOINCREMENT, base_id INTEGER, depth INTEGER, changed BLOB, removed BLOB)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS bugs (bug_id TEXT PRIMARY KEY, manifest_id INTEGER)")
+        self.code_search_index = CodeSearchIndex(self._connection)
+        self.call_graph_index = CallGraphIndex(self._connection)
+        self._connection.commit()
+
+        row = self._connection.execute("SELECT value FROM store_info WHERE key = 'bodies_size'").fetchone()
+        self._bodies_size = int(row[0]) if row else 0
+        open(self._bodies_path, 'ab').close()
+
+        self._latest_manifest = None
+        self._record_hashes = {}
+
+    def _invalidate_if_stale(self):
+        row = self._connection.execute("SELECT value FROM store_info WHERE key = 'version'").fetchone()
+        if row is None or int(row[0]) != STORE_VERSION:
+            for table in ('file_records', 'method_bodies', 'manifests', 'bugs', 'code_tokens', 'code_trigrams',
+                          'reference_postings', 'record_references'):
+                self._connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self._connection.execute("DELETE FROM store_info")
+            self._connection.execute("INSERT INTO store_info VALUES ('version', ?)", (str(STORE_VERSION),))
+            self._connection.commit()
+
+    def _hash_records(self, filewise_method_data):
+        # entries are replaced, never edited in place, so an unchanged object keeps its hash
+        record_hashes = {}
+        for file_path, file_entry in filewise_method_data.items():
+            known = self._record_hashes.get(file_path)
+            if known is not None and known[0] is file_entry:
+                record_hashes[file_path] = known
+            else:
+                record_hashes[file_path] = (file_entry, calculate_record_hash(file_entry))
+        self._record_hashes = record_hashes
+        return {file_path: record_hash for file_path, (_, record_hash) in record_hashes.items()}
+
+    def _select_existing(self, query, keys):
+        rows = []
+        for i in range(0, len(keys), 900):
+            subset_of_keys = keys[i:i + 900]
+            placeholders = ','.join('?' * len(subset_of_keys))
+            rows.extend(self._connection.execute(query.format(placeholders=placeholders), subset_of_keys))
+        return rows
+
+    def _store_bodies(self, bodies):
+        """Append the (body hash, body) pairs not stored yet and return body hash -> (offset, length)"""
+        body_hashes = dict(bodies)
+        spans = {body_hash: (offset, length) for body_hash, offset, length in self._select_existing(
+            "SELECT body_hash, offset, length FROM method_bodies WHERE body_hash IN ({placeholders})", list(body_hashes))}
+        new_bodies = []
+        with open(self._bodies_path, 'r+b') as bodies_file:
+            # drop bodies appended by a run that died before committing the records using them
+            bodies_file.truncate(self._bodies_size)
+            bodies_file.seek(self._bodies_size)
+            for body_hash, body in body_hashes.items():
+                if body_hash not in spans:
+                    spans[body_hash] = (self._bodies_size, len(body))
+                    new_bodies.append((body_hash, self._bodies_size, len(body)))
+                    bodies_file.write(body)
+                    self._bodies_size += len(body)
+        self._connection.executemany("INSERT INTO method_bodies VALUES (?, ?, ?)", new_bodies)
+        return spans
+
+    def save_snapshot(self, bug_id, filewise_method_data):
+        manifest = self._hash_records(filewise_method_data)
+        with self._lock:
+            known = {record_hash for record_hash, in self._select_existing(
+                "SELECT record_hash FROM file_records WHERE record_hash IN ({placeholders})", list(set(manifest.values())))}
+            new_records = {}
+            for file_path, record_hash in manifest.items():
+                if record_hash not in known and record_hash not in new_records:
+                    new_records[record_hash] = filewise_method_data[file_path]
+
+            hashed_bodies = {}
+            for record_hash, file_entry in new_records.items():
+                bodies = [method['body'].encode('utf-8') for method in file_entry['methods']]
+                hashed_bodies[record_hash] = [(hashlib.sha256(body).hexdigest(), body) for body in bodies]
+            spans = self._store_bodies([body for bodies in hashed_bodies.values() for body in bodies])
+            self._connection.executemany("INSERT INTO file_records VALUES (?, ?, ?)", [
+                (record_hash, file_entry['package'], compress_json([
+                    [method['signature'], *spans[body_hash]]
+                    for method, (body_hash, _) in zip(file_entry['methods'], hashed_bodies[record_hash])]))
+                for record_hash, file_entry in new_records.items()])
+            self.code_search_index.add_records({
+                record_hash: [method['body'] for method in file_entry['methods']]
+                for record_hash, file_entry in new_records.items()})
+            self.call_graph_index.add_records({
+                record_hash: file_entry['references'] for record_hash, file_entry in new_records.items()})
+            self._connection.execute(
+                "INSERT OR REPLACE INTO store_info VALUES ('bodies_size', ?)", (str(self._bodies_size),))
+
+            if self._latest_manifest is not None and self._latest_manifest[1] < MAX_DELTA_CHAIN:
+                base_id, base_depth, base_manifest = self._latest_manifest
+                changed = {file_path: record_hash for file_path, record_hash in manifest.items()
+                           if base_manifest.get(file_path) != record_hash}
+                removed = [file_path for file_path in base_manifest if file_path not in manifest]
+                depth = base_depth + 1
+            else:
+                base_id, changed, removed, depth = None, manifest, [], 0
+            cursor = self._connection.execute(
+                "INSERT INTO manifests (base_id, depth, changed, removed) VALUES (?, ?, ?, ?)",
+                (base_id, depth, compress_json(changed), compress_json(removed)))
+            self._connection.execute("INSERT OR REPLACE INTO bugs VALUES (?, ?)", (bug_id, cursor.lastrowid))
+            self._connection.commit()
+            self._latest_manifest = (cursor.lastrowid, depth, manifest)
+            return len(new_records)
+
+    def has_snapshot(self, bug_id):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM bugs WHERE bug_id = ?", (bug_id,)).fetchone() is not None
+
+    def load_manifest(self, bug_id):
+        """Return the bug's file path -> record hash map, or None if it was never saved"""
+        with self._lock:
+            row = self._connection.execute("SELECT manifest_id FROM bugs WHERE bug_id = ?", (bug_id,)).fetchone()
+            if row is None:
+                return None
+            deltas = []
+            manifest_id = row[0]
+            while manifest_id is not None:
+                base_id, changed, removed = self._connection.execute(
+                    "SELECT base_id, changed, removed FROM manifests WHERE manifest_id = ?", (manifest_id,)).fetchone()
+                deltas.append((changed, removed))
+                manifest_id = base_id
+
+        manifest = {}
+        for changed, removed in reversed(deltas):
+            for file_path in decompress_json(removed):
+                del manifest[file_path]
+            manifest.update(decompress_json(changed))
+        return manifest
+
+    def load_records(self, record_hashes):
+        """Return record hash -> (package, signatures, body spans) for the given hashes"""
+        records = {}
+        with self._lock:
+            for record_hash, package, methods in self._select_existing(
+                    "SELECT record_hash, package, methods FROM file_records WHERE record_hash IN ({placeholders})",
+                    list(set(record_hashes))):
+                methods = decompress_json(methods)
+                records[record_hash] = (package, tuple(method[0] for method in methods),
+                                        tuple((method[1], method[2]) for method in methods))
+        return records
+
+    def open_snapshot(self, bug_id):
+        """Open a bug's snapshot as a SnapshotView, or return None if it was never saved"""
+        manifest = self.load_manifest(bug_id)
+        if manifest is None:
+            return None
+        return SnapshotView(self, bug_id, manifest, self.load_records(manifest.values()))
+
+    def find_code_token(self, token, record_hashes):
+        with self._lock:
+            return self.code_search_index.find_token(token, record_hashes)
+
+    def find_literal_candidates(self, literal, record_hashes):
+        with self._lock:
+            return self.code_search_index.find_literal_candidates(literal, record_hashes)
+
+    def find_references(self, kind, name, record_hashes, arguments=None):
+        with self._lock:
+            return self.call_graph_index.find_references(kind, name, record_hashes, arguments)
+
+    def load_references(self, record_hashes):
+        with self._lock:
+            return self.call_graph_index.load_references(record_hashes)
+
+    def read_body(self, offset, length):
+        if length == 0:
+            return ''
+        with self._lock:
+            if self._bodies_map is None or offset + length > len(self._bodies_map):
+                # another process may have appended since the file was mapped
+                if self._bodies_map is not None:
+                    self._bodies_map.close()
+                with open(self._bodies_path, 'rb') as bodies_file:
+                    self._bodies_map = mmap.mmap(bodies_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._bodies_map[offset:offset + length].decode('utf-8')
+
+    def load_file_data(self, bug_id):
+        """Materialize a bug's snapshot, bodies included, as file path -> {'package', 'methods', 'references'}"""
+        snapshot = self.open_snapshot(bug_id)
+        if snapshot is None:
+            return None
+        references = self.load_references(snapshot.manifest.values())
+        file_data = {}
+        for file_path in snapshot.paths:
+            signatures = snapshot.get_signatures(file_path)
+            file_data[file_path] = {
+                'package': snapshot.get_package(file_path),
+                'methods': [{'signature': signature, 'body': snapshot.get_method_body(file_path, i)}
+                            for i, signature in enumerate(signatures)],
+                'references': references[snapshot.manifest[file_path]]
+            }
+        return file_data
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "bugs": self._connection.execute("SELECT COUNT(*) FROM bugs").fetchone()[0],
+                "file_records": self._connection.execute("SELECT COUNT(*) FROM file_records").fetchone()[0],
+                "method_bodies": self._connection.execute("SELECT COUNT(*) FROM method_bodies").fetchone()[0],
+                "manifests": self._connection.execute("SELECT COUNT(*) FROM manifests").fetchone()[0],
+                "bodies_mb": round(self._bodies_size / (1024 * 1024), 2)
+            }
+
+    def close(self):
+        with self._lock:
+            if self._bodies_map is not None:
+                self._bodies_map.close()
+                self._bodies_map = None
+            self._connection.close()
+
+
+class SnapshotRegistry:
+    """Shares read-only SnapshotViews between the bugs being localized concurrently.
+
+    Views are reference counted and evicted once no in-flight bug holds them. The file
+    records behind the views are shared too, so bugs whose snapshots overlap keep one
+    copy of every file record they have in common.
+    """
+    def __init__(self, snapshot_store):
+        self.snapshot_store = snapshot_store
+        self._lock = threading.Lock()
+        self._views = {}
+        self._records = {}
+        self.opened_views = 0
+        self.reused_views = 0
+        self.loaded_records = 0
+        self.shared_records = 0
+
+    def acquire(self, bug_id):
+        """Return the bug's shared view, or None if no snapshot was saved for it"""
+        with self._lock:
+            if bug_id in self._views:
+                self._views[bug_id][1] += 1
+                self.reused_views += 1
+                return self._views[bug_id][0]
+
+            manifest = self.snapshot_store.load_manifest(bug_id)
+            if manifest is None:
+                return None
+            manifest = {sys.intern(file_path): record_hash for file_path, record_hash in manifest.items()}
+            record_hashes = set(manifest.values())
+            missing = [record_hash for record_hash in record_hashes if record_hash not in self._records]
+            for record_hash, record in self.snapshot_store.load_records(missing).items():
+                self._records[record_hash] = [record, 0, self._estimate_size(record)]
+            self.loaded_records += len(missing)
+            self.shared_records += len(record_hashes) - len(missing)
+            for record_hash in record_hashes:
+                self._records[record_hash][1] += 1
+
+            view = SnapshotView(self.snapshot_store, bug_id, manifest,
+                                {record_hash: self._records[record_hash][0] for record_hash in record_hashes})
+            view.record_hashes = record_hashes
+            self._views[bug_id] = [view, 1]
+            self.opened_views += 1
+            return view
+
+    def release(self, bug_id):
+        with self._lock:
+            entry = self._views.get(bug_id)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._views[bug_id]
+            for record_hash in entry[0].record_hashes:
+                self._records[record_hash][1] -= 1
+                if self._records[record_hash][1] == 0:
+                    del self._records[record_hash]
+
+    def _estimate_size(self, record):
+        package, signatures, body_spans = record
+        return (sys.getsizeof(package) + sys.getsizeof(signatures) + sys.getsizeof(body_spans)
+                + sum(sys.getsizeof(signature) for signature in signatures) + 64 * len(body_spans))
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "open_views": len(self._views),
+                "references": sum(references for _, references in self._views.values()),
+                "opened_views": self.opened_views,
+                "reused_views": self.reused_views,
+                "resident_records": len(self._records),
+                "loaded_records": self.loaded_records,
+                "shared_records": self.shared_records,
+                "resident_mb": round(sum(size for _, _, size in self._records.values()) / (1024 * 1024), 2)
+            }
+
+
+def get_snapshot_store_path(project):
+    return f"{project}_bug_data/snapshot_store.sqlite"
+
+
+def get_snapshot_store(project):
+    """One shared store per project, opened on first use"""
+    with snapshot_stores_lock:
+        if project not in snapshot_stores:
+            snapshot_stores[project] = SnapshotStore(get_snapshot_store_path(project))
+        return snapshot_stores[project]
+
+
+def get_snapshot_registry(project):
+    store = get_snapshot_store(project)
+    with snapshot_stores_lock:
+        if project not in snapshot_registries:
+            snapshot_registries[project] = SnapshotRegistry(store)
+        return snapshot_registries[project]
+
+
+def close_snapshot_stores():
+    with snapshot_stores_lock:
+        for snapshot_store in snapshot_stores.values():
+            snapshot_store.close()
+        snapshot_stores.clear()
+        snapshot_registries.clear()
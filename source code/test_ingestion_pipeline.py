@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+from unittest import mock
+from config import Config
+import collection_handler
+from collection_handler import IngestionPipeline
+
+# a hung close() would block the test run forever, so it runs on a thread with a deadline
+CLOSE_TIMEOUT = 10
+
+
+class FailingCollection:
+    def __init__(self, fail_upsert=False):
+        self.fail_upsert = fail_upsert
+        self.upserted_ids = []
+
+    def upsert(self, documents, metadatas, embeddings, ids):
+        if self.fail_upsert:
+            raise RuntimeError("upsert failed")
+        self.upserted_ids.extend(ids)
+
+
+def failing_embed_documents(ids, documents):
+    raise RuntimeError("embedding failed")
+
+
+def add_chunks(pipeline, num_chunks):
+    ids = [f"chunk{i}" for i in range(num_chunks)]
+    documents = [f"public void method{i}() {{ return; }}" for i in range(num_chunks)]
+    pipeline.add(ids, documents, [{"file": f"File{i % 5}.java"} for i in range(num_chunks)])
+
+
+def close_with_deadline(pipeline):
+    outcome = {}
+
+    def close():
+        try:
+            pipeline.close()
+        except BaseException as error:
+            outcome['error'] = error
+
+    thread = threading.Thread(target=close, daemon=True)
+    thread.start()
+    thread.join(CLOSE_TIMEOUT)
+    return thread.is_alive(), outcome.get('error')
+
+
+class IngestionPipelineTest(unittest.TestCase):
+    def setUp(self):
+        Config().set_embedding_type('openai')
+        patcher = mock.patch.object(collection_handler, 'get_embedding_function', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_inserts_every_batch(self):
+        collection = FailingCollection()
+        with mock.patch.object(collection_handler, 'embed_documents', return_value=None):
+            pipeline = IngestionPipeline(collection, batch_tokens=20, max_batch_size=3)
+            add_chunks(pipeline, 50)
+            hung, error = close_with_deadline(pipeline)
+        self.assertFalse(hung)
+        self.assertIsNone(error)
+        self.assertEqual(sorted(collection.upserted_ids), sorted(f"chunk{i}" for i in range(50)))
+
+    def test_embedding_failure_is_raised_by_close(self):
+        with mock.patch.object(collection_handler, 'embed_documents', failing_embed_documents):
+            pipeline = IngestionPipeline(FailingCollection(), batch_tokens=20, max_batch_size=3, queue_size=1)
+            try:
+                add_chunks(pipeline, 50)
+            except RuntimeError:
+                pass
+            hung, error = close_with_deadline(pipeline)
+        self.assertFalse(hung)
+        self.assertEqual(str(error), "embedding failed")
+
+    def test_insertion_failure_is_raised_by_close(self):
+        with mock.patch.object(collection_handler, 'embed_documents', return_value=None):
+            pipeline = IngestionPipeline(FailingCollection(fail_upsert=True), batch_tokens=20, max_batch_size=3)
+            add_chunks(pipeline, 4)
+            pipeline._flush_batch()
+            # the embedding stage is left idle, waiting for the next batch
+            for _ in range(100):
+                if pipeline._error is not None:
+                    break
+                time.sleep(0.05)
+            hung, error = close_with_deadline(pipeline)
+        self.assertFalse(hung)
+        self.assertEqual(str(error), "upsert failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
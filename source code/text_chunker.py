@@ -0,0 +1,92 @@
+import re
+
+DEFAULT_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+
+def split_keeping_separator(text, separator):
+    # same pieces as RecursiveCharacterTextSplitter: the separator starts the piece after it
+    if separator:
+        parts = re.split(f"({re.escape(separator)})", text)
+        splits = [parts[0]] + [parts[i] + parts[i + 1] for i in range(1, len(parts), 2)]
+    else:
+        splits = list(text)
+    return [split for split in splits if split != ""]
+
+
+class TokenChunker:
+    """Recursive separator chunker that produces the same chunks as LangChain's
+    RecursiveCharacterTextSplitter with a token length function and no overlap.
+
+    Each piece is tokenized once, through a batch length function, instead of being
+    re-measured at every merge step.
+    """
+    def __init__(self, chunk_size, batch_length_function, separators=DEFAULT_SEPARATORS):
+        self.chunk_size = chunk_size
+        self.batch_length_function = batch_length_function
+        self.separators = separators
+
+    def _measure(self, pieces, lengths):
+        unmeasured = [piece for piece in dict.fromkeys(pieces) if piece not in lengths]
+        if unmeasured:
+            lengths.update(zip(unmeasured, self.batch_length_function(unmeasured)))
+
+    def _pick_separator(self, text, separators):
+        for i, separator in enumerate(separators):
+            if separator == "":
+                return separator, []
+            if separator in text:
+                return separator, separators[i + 1:]
+        return separators[-1], []
+
+    def _merge_splits(self, splits, lengths):
+        chunks = []
+        current_chunk = []
+        total = 0
+        for split in splits:
+            split_length = lengths[split]
+            if total + split_length > self.chunk_size:
+                if current_chunk:
+                    chunk = ''.join(current_chunk).strip()
+                    if chunk:
+                        chunks.append(chunk)
+                    while total > 0:
+                        total -= lengths[current_chunk[0]]
+                        current_chunk = current_chunk[1:]
+            current_chunk.append(split)
+            total += split_length
+        chunk = ''.join(current_chunk).strip()
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _split_text(self, text, separators, lengths):
+        separator, remaining_separators = self._pick_separator(text, separators)
+        splits = split_keeping_separator(text, separator)
+        self._measure(splits, lengths)
+
+        chunks = []
+        good_splits = []
+        for split in splits:
+            if lengths[split] < self.chunk_size:
+                good_splits.append(split)
+                continue
+            if good_splits:
+                chunks.extend(self._merge_splits(good_splits, lengths))
+                good_splits = []
+            if remaining_separators:
+                chunks.extend(self._split_text(split, remaining_separators, lengths))
+            else:
+                chunks.append(split)
+        if good_splits:
+            chunks.extend(self._merge_splits(good_splits, lengths))
+        return chunks
+
+    def split_texts(self, texts):
+        """Chunk a batch of texts, measuring the top-level pieces of all of them in one call"""
+        lengths = {}
+        top_level_splits = [split_keeping_separator(text, self._pick_separator(text, self.separators)[0]) for text in texts]
+        self._measure([split for splits in top_level_splits for split in splits], lengths)
+        return [self._split_text(text, self.separators, lengths) for text in texts]
+
+    def split_text(self, text):
+        return self.split_texts([text])[0]
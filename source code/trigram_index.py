@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def get_trigrams(text):
+    # padding lets the start and end of a name count as trigrams of their own
+    padded = f"  {text.lower()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """Trigram posting lists over a fixed list of strings, scored with the Dice coefficient"""
+    def __init__(self, texts):
+        postings = {}
+        self.size = len(texts)
+        self.trigram_counts = np.zeros(self.size, dtype=np.int32)
+        for position, text in enumerate(texts):
+            trigrams = get_trigrams(text)
+            self.trigram_counts[position] = len(trigrams)
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(position)
+        self.postings = {trigram: np.array(positions, dtype=np.int32) for trigram, positions in postings.items()}
+
+    def score(self, query):
+        """Similarity of the query to every indexed string, as an array in index order"""
+        trigrams = get_trigrams(query)
+        posting_lists = [self.postings[trigram] for trigram in trigrams if trigram in self.postings]
+        if not posting_lists:
+            return np.zeros(self.size)
+        common = np.bincount(np.concatenate(posting_lists), minlength=self.size)
+        return 2 * common / (len(trigrams) + self.trigram_counts)
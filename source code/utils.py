@@ -1,9 +1,10 @@
 import os
 import json
 import hashlib
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from config import Config
-from embedding_handler import alibaba_tokenize, openai_tokenize
+from embedding_handler import alibaba_tokenize, openai_tokenize, onnx_tokenize, alibaba_tokenize_batch, openai_tokenize_batch, \
+    onnx_tokenize_batch
+from text_chunker import TokenChunker
 
 def count_tokens(text):
     config = Config()
@@ -12,11 +13,22 @@ def count_tokens(text):
         return alibaba_tokenize(text)
     elif embedding_type == 'openai':
         return openai_tokenize(text)
+    elif embedding_type == 'gte-onnx':
+        return onnx_tokenize(text)
 
-entity_splitter = RecursiveCharacterTextSplitter(
+def count_tokens_batch(texts):
+    config = Config()
+    embedding_type = config.get_embedding_type()
+    if embedding_type == 'gte':
+        return alibaba_tokenize_batch(texts)
+    elif embedding_type == 'openai':
+        return openai_tokenize_batch(texts)
+    elif embedding_type == 'gte-onnx':
+        return onnx_tokenize_batch(texts)
+
+entity_splitter = TokenChunker(
     chunk_size = 300,
-    chunk_overlap = 0,
-    length_function=count_tokens
+    batch_length_function=count_tokens_batch
 )
 
 def calculate_hash(content):
@@ -25,10 +37,19 @@ def calculate_hash(content):
     hash_value = hash_object.hexdigest()
     return hash_value
 
+def calculate_blob_hash(content_bytes):
+    # hashes the raw file bytes, so the key is the id git gives the blob of a file checked out unchanged
+    hash_object = hashlib.sha1(b'blob %d\0' % len(content_bytes))
+    hash_object.update(content_bytes)
+    return hash_object.hexdigest()
+
 def get_chunks(entity):
     chunks = entity_splitter.split_text(entity)
     return chunks
 
+def get_chunks_of_entities(entities):
+    return entity_splitter.split_texts(entities)
+
 def get_filename_from_path(fully_qualified_filename):
     return os.path.basename(fully_qualified_filename)
 